@@ -81,11 +81,30 @@ Here is a full listing of all available settings:
                          as one big file. That way you can split the hdd into
                          smaller pieces.
 
+                         Input files compressed with gzip or xz are detected
+                         automatically and decompressed on the fly. An xz
+                         compressed file requires the module lzma
+                         (backports.lzma for Python 2). The first scan
+                         stores a seek index in the database, later seeks
+                         start at the nearest gzip member, xz stream or full
+                         flush point (e.g. written by pigz --independent).
+
                          parameter clear:   clear list of input file
                          parameter add:     add one file to list of input files
                          parameter del:     delete one file from list of input
                                             files
 
+  source add [name] [filename]
+  source del [name] [filename]
+  source clear [name]    Define further inputs (e.g. the disks of several
+                         recorders) under a name, each of them with its own
+                         list of files like the setting "input". The
+                         parameter "create" scans all sources and the input
+                         files at the same time, one process per source.
+                         All chunks are stored in the same database; sort
+                         only concatenates chunks of the same source. The
+                         mapfile only applies to the input files.
+
   export_dir [string]    Defines where the output should be written to. Must
                          match an existing path. Both relative and absolute
                          paths are accepted. Current directory is "./".
@@ -109,12 +128,88 @@ Here is a full listing of all available settings:
                          it finds two frames where the timecode differs more
                          than this value. MPEG uses a clock of 90 kHz.
                          So the default value of 90,000 ticks equals one second.
+                         The clock wraps around after 2^33 ticks (about 26.5
+                         hours), a stream crossing the wraparound is not
+                         split.
 
   max_sort_gap [integer]
                          See maxcreategap. This value is used to concatenate
                          two chunks if the difference of the timecode is smaller
                          than this value. The default value of 90,000 ticks
-                         equals one second.
+                         equals one second. The wraparound of the clock is
+                         taken into account like in max_create_gap.
+
+  scan_mode [string]     Either "aligned" or "unaligned". The default mode
+                         "aligned" only checks the first bytes of every block
+                         for a pack header. The mode "unaligned" searches the
+                         whole input for pack headers, so packs which are not
+                         aligned to the blocksize (e.g. images taken with an
+                         offset) are found as well. Chunks are stored with
+                         exact byte offsets in this mode.
+
+  survey_step [integer]  Distance of the blocks probed by the parameter
+                         "survey" (value must be given in blocks!). The
+                         default value is 32768 blocks (64 MiB by blocksize of
+                         2048 bytes).
+
+  follow_timeout [integer]
+                         Seconds "create --follow" waits for the input to grow
+                         before it finishes the scan. The default value is 60
+                         seconds.
+
+  io_rate [number]       Maximum rate (MiB/s) the input is read with by the
+                         parameters "create", "survey", "export" and "serve".
+                         The sources scanned at the same time share the
+                         limit. The default value 0 means unlimited.
+
+  io_priority [string]   I/O scheduling class of the process (Linux only):
+                         "idle", "best-effort:LEVEL" or "realtime:LEVEL"
+                         (level 0 to 7, 0 is the highest priority). The
+                         default is "none" (not changed).
+
+                         Both values can be changed while the program is
+                         running: write lines like "io_rate 20" or
+                         "io_priority idle" to the file "dvr-recover.io" in
+                         the working directory. Changes of the file are
+                         taken over within a second. A file written before
+                         the program started is ignored.
+
+  cache_file [filename]  The results of every finished scan are stored in this
+                         sqlite3 database, identified by a fingerprint of the
+                         input (sizes and sampled blocks) and the settings of
+                         the scan. Parameter "create" loads the chunks from
+                         this file instead of scanning the input again if the
+                         same image is used in another directory or under
+                         another path. Use "none" to disable the cache. The
+                         default is "~/.dvr-recover-cache.sqlite".
+
+  formats [list]         Comma separated list of the stream formats to detect
+                         in the aligned scan mode: "ps" (MPEG program
+                         stream, pack headers with SCR) and "ts" (MPEG
+                         transport stream with 188 or 192 bytes packets,
+                         clock taken from the PCR). All formats are detected
+                         in the same pass. The default is "ps,ts". Chunks of
+                         transport streams are exported as .ts files.
+
+  export_sync [string]   When the exported files are forced to disk: "file"
+                         syncs every file as soon as it is complete, "end"
+                         syncs all files after the export, "none" leaves it
+                         to the operating system. The default is "end".
+
+  export_duplicates [string]
+                         What the parameter "export" does with recordings
+                         marked by the parameter "dedup": "copy" exports
+                         them like all other recordings, "skip" doesn't
+                         export them and "link" creates a hard link to the
+                         exported file of the copy kept (a trimmed copy
+                         becomes the complete recording). The default is
+                         "copy".
+
+  mapfile [filename]     Path of the mapfile (logfile) written by GNU ddrescue
+  mapfile clear          while imaging the hdd. Only regions marked as
+                         finished are scanned; unread and bad areas split the
+                         chunks. The parameter "show" marks chunks which
+                         overlap or border such areas as damaged.
 
 
 Input hdd file
@@ -147,9 +242,40 @@ Step 1: Export information of chunks
   once. All other steps will use the stored chunk info to save time.
   (The script tries to find mpeg headers and extract the timecode. Depending on
   the timecode it's possible to split the stream into separate chunks.)
+  Holes of sparse image files (e.g. created by "ddrescue --sparse") are
+  skipped without reading them.
 
   Parameter: create
 
+  Pass "--follow" to scan an image while it is still being copied (e.g. by
+  dd): The scan reads up to the current end of the last input file and waits
+  for it to grow. It finishes when the file hasn't grown for follow_timeout
+  seconds.
+
+  Pass "--follow-mapfile" to scan an image while ddrescue is still running:
+  The scan pauses in front of areas ddrescue hasn't tried yet and continues
+  as soon as they are rescued. Areas ddrescue failed to read in its first
+  pass are treated as bad.
+
+  Alternatively use the parameter "survey": It probes a sparse grid of blocks
+  first and prints the regions where pack headers were found. Then these
+  regions are scanned completely, the regions with the most pack headers
+  first, followed by the rest of the input. While the survey is running you
+  can already call "sort", "show" and "export" from another terminal (they
+  see the chunks found so far). An interrupted survey continues with the
+  next region on the next call. The result of a finished survey is
+  identical to the result of "create".
+
+  Parameter: survey
+
+  Every scan also stores a compact map of the runs of pack headers. After
+  changing min_chunk_size or max_create_gap the parameter "rechunk" rebuilds
+  the chunks from this map in seconds instead of scanning the input again.
+  The result equals a full scan unless max_create_gap is set below 9000
+  ticks; rechunk prints a warning in this case.
+
+  Parameter: rechunk
+
 Step 2: Analyze and sort chunks
   This step will analyze the stored chunk info and sort the chunks. The tools
   tries to find parts of the same recording (by analyzing the timecode
@@ -157,20 +283,70 @@ Step 2: Analyze and sort chunks
 
   Parameter: sort
 
+  Recorders often keep several copies of the same recording (e.g. timeshift
+  buffers). The parameter "dedup" compares the recordings found by "sort"
+  (clock range, size and a hash of sampled blocks) and marks every further
+  copy as duplicate of the first one on the disk. Trimmed or edited copies
+  are found as well: a recording whose clock range lies within the one of a
+  longer recording (up to 5 seconds more at both ends) is a duplicate of it
+  if most of its sampled blocks are found there at the same clock. Depending
+  on the setting export_duplicates these copies are exported, skipped or
+  hard linked.
+
+  Parameter: dedup
+
 Step 3: Show chunks
   You can list all chunks to make sure that the program did the job properly.
 
   Parameter: show
 
+  Large lists can be filtered: "--min-size" (blocks of the recording),
+  "--min-parts"/"--max-parts" (chunks per recording), "--clock START:END" and
+  "--blocks START:END" (recordings overlapping the range; either side may be
+  omitted; a recording continuing across the wraparound of the clock covers
+  the clock up to the end and from 0). "--sort" orders the recordings by
+  number (default), size, parts or block, "--limit" and "--offset" select a
+  page. The numbers shown are always the numbers used by "export". With
+  "--json" every recording is printed as one JSON object per line.
+
+  "create" also collects statistics of every chunk, which help to filter out
+  junk: "--min-rate"/"--max-rate" (bytes per second of the clock, every part
+  of the recording), "--stream ID" (recordings containing PES packets of the
+  stream id in hex, e.g. e0 for the first video or c0 for the first audio
+  stream) and "--max-clockless" (blocks without clock inside the chunks,
+  e.g. transport stream packets without PCR). The statistics are included in
+  the JSON output.
+
 Step 4: Export chunks
   This step will use the conditioned chunk data and export the chunks. You can
   either export all chunks at once or select chunks. The tool will assembly all
   parts of the same recording into one file.
   Use paramater "show" to get the id of the chunk you want to extract. If you
   call export without any additional parameter, all chunks will be exported.
+  Chunk ids do not change when the chunks are sorted again. Several ids and
+  ranges can be given at once (e.g. "export 12,40-55"); every recording
+  containing one of the chunks is exported, named by its number as printed
+  by "show".
+  The progress of the export is saved regularly and when it fails (e.g. an
+  error writing the output). If an export was interrupted, run it again with
+  the same chunk ids and "--resume": complete files are skipped and partly
+  written files are continued. Sampled blocks of the data written before are
+  compared with the input first, a file which differs is exported again.
+  Without saved progress (e.g. after a finished export) the complete output
+  files are skipped.
 
   Parameter: export
 
+  To preview the recordings without exporting them, pass the parameter
+  "serve" (optionally followed by a port, default 8080). The recordings are
+  listed on http://127.0.0.1:8080/ and can be streamed and seeked directly
+  by a media player. Nothing is written to disk.
+
+  Your own Python tools can read a recording without exporting it, too:
+  RecordingStream(db_manager, chunk, reader, blocksize) returns a seekable
+  file object (read, readinto, seek, tell) for the chain starting with
+  chunk.
+
 
 Additional Parameters:
 ----------------------
@@ -184,11 +360,26 @@ setup input clear
 setup input add [FILE]
 setup input remove [FILE]
 
+setup source add [NAME] [FILE]
+setup source del [NAME] [FILE]
+setup source clear [NAME]
+
 setup blocksize [INTEGER]
 setup exportdir [STRING]
 setup minchunksize [INTEGER]
 setup maxcreategap [INTEGER]
 setup maxsortgap [INTEGER]
+setup survey_step [INTEGER]
+setup follow_timeout [INTEGER]
+setup io_rate [NUMBER]
+setup io_priority [none|idle|best-effort:LEVEL|realtime:LEVEL]
+setup cache_file [FILE|none]
+setup scan_mode [aligned|unaligned]
+setup formats [ps|ts|ps,ts]
+setup export_sync [none|file|end]
+setup export_duplicates [copy|skip|link]
+setup mapfile [FILE]
+setup mapfile clear
 
 
 
@@ -197,12 +388,19 @@ Usage:
 
   usage
   setup [setup-args]
-  create
+  create [--follow|--follow-mapfile]
+  survey
+  rechunk
   sort
   reset
+  dedup
   clear
-  show
-  export [chunk-id]
+  show [--min-size BLOCKS] [--min-parts N] [--max-parts N]
+       [--clock START:END] [--blocks START:END] [--min-rate BYTES]
+       [--max-rate BYTES] [--stream ID] [--max-clockless BLOCKS]
+       [--sort number|size|parts|block] [--limit N] [--offset N] [--json]
+  export [--resume] [chunk-id[-chunk-id][,...]]
+  serve [port]
 
 
 Tested devices:
@@ -219,11 +417,154 @@ Tested devices:
 '''
 
 
+import BaseHTTPServer
+import bisect
+import cgi
+import errno
+import hashlib
+import json
+import multiprocessing
 import os
 import os.path
+import platform
+import re
+import socket
+import SocketServer
 import sqlite3
 import sys
+import threading
 import time
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# posix_fallocate reserves the blocks of the output files, so large exports
+# are not fragmented; os.truncate is used where it is not available
+posix_fallocate = getattr(os, 'posix_fallocate', None)
+if posix_fallocate is None:
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        try:
+            libc_fallocate = libc.posix_fallocate64
+        except AttributeError:
+            libc_fallocate = libc.posix_fallocate
+        libc_fallocate.argtypes = (ctypes.c_int, ctypes.c_longlong,
+                                   ctypes.c_longlong)
+
+        def posix_fallocate(fd, offset, length):
+            result = libc_fallocate(fd, offset, length)
+            if result != 0:
+                raise OSError(result, os.strerror(result))
+    except (ImportError, OSError, AttributeError, TypeError):
+        posix_fallocate = None
+
+# ioprio_set is only available as system call on Linux
+IOPRIO_SYSCALLS = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30,
+                   'armv7l': 314, 'ppc64le': 273, 'ppc64': 273}
+ioprio_set = None
+if (sys.platform.startswith('linux') and
+    (platform.machine() in IOPRIO_SYSCALLS)):
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+        def ioprio_set(ioprio):
+            '''Set I/O priority of the current process'''
+            # IOPRIO_WHO_PROCESS = 1, 0 is the calling process
+            result = libc.syscall(IOPRIO_SYSCALLS[platform.machine()],
+                                  1, 0, ioprio)
+            if result != 0:
+                error = ctypes.get_errno()
+                raise OSError(error, os.strerror(error))
+    except (ImportError, OSError, AttributeError):
+        ioprio_set = None
+
+
+PACK_START_CODE = '\x00\x00\x01\xba'
+TS_SYNC_BYTE = '\x47'
+TS_PACKET_SIZES = (188, 192)
+FORMATS = ('ps', 'ts')
+# clock returned for blocks of a known format which carry no clock
+NO_CLOCK = -1
+# SCR and PCR base are 33 bit counters, they wrap after about 26.5 hours
+CLOCK_MODULUS = 2**33
+CLOCK_FREQUENCY = 90000
+SCAN_MODES = ('aligned', 'unaligned')
+SCAN_BUFFER_SIZE = 4 * 1024**2
+EXPORT_BUFFER_SIZE = 4 * 1024**2
+MAX_OPEN_OUTPUT_FILES = 64
+# write-behind buffer of every output file and limit for all buffers
+OUTPUT_BUFFER_SIZE = 16 * 1024**2
+MAX_OUTPUT_BUFFERED = 128 * 1024**2
+EXPORT_SYNC_MODES = ('none', 'file', 'end')
+# progress of export is saved after reading this many bytes
+EXPORT_CHECKPOINT_INTERVAL = 256 * 1024**2
+EXPORT_DUPLICATES_MODES = ('copy', 'skip', 'link')
+# gzip magic and compression method deflate
+GZIP_MAGIC = '\x1f\x8b\x08'
+XZ_MAGIC = '\xfd7zXZ\x00'
+COMPRESSED_READ_SIZE = 256 * 1024
+CHECKPOINT_INTERVAL = 64 * 1024**2
+MAX_CHECKPOINTS = 1024
+# empty stored block written by a (full) flush of a deflate stream
+FLUSH_MARKER = '\x00\x00\xff\xff'
+# a flush point is a checkpoint if the data behind it is decompressed
+# correctly without the data in front of it (window: 32 KiB)
+FLUSH_POINT_VERIFY = 64 * 1024
+FLUSH_POINT_ATTEMPTS = 16
+
+# whence values for lseek to skip holes in sparse files
+SEEK_DATA = getattr(os, 'SEEK_DATA', None)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', None)
+if (SEEK_DATA is None) and sys.platform.startswith('linux'):
+    SEEK_DATA = 3
+    SEEK_HOLE = 4
+
+MAPFILE_POLL_INTERVAL = 10
+# seconds between the checks for growth of the input in "create --follow"
+FOLLOW_POLL_INTERVAL = 1
+# io_rate and io_priority can be changed at runtime in this file, it is
+# checked at this interval (seconds)
+IO_CONTROL_FILE = 'dvr-recover.io'
+IO_CONTROL_INTERVAL = 1
+# classes of ioprio_set, the level (0-7) is ignored for idle
+IO_PRIORITY_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+SERVE_PORT = 8080
+SERVE_BUFFER_SIZE = 256 * 1024
+FINGERPRINT_SAMPLES = 64
+# dedup: a trimmed or edited copy may exceed the clock range of the original
+# by this many ticks; DEDUP_SAMPLES blocks of the copy are searched in the
+# original (within windows of DEDUP_WINDOW bytes), DEDUP_MIN_MATCHES of them
+# must be found
+DEDUP_CLOCK_TOLERANCE = 5 * CLOCK_FREQUENCY
+DEDUP_SAMPLES = 16
+DEDUP_WINDOW = 256 * 1024
+DEDUP_MIN_MATCHES = 13
+# header runs are split at larger SCR steps; rechunk is exact as long as
+# max_create_gap is not smaller than the largest step inside a run
+RUN_SPLIT_GAP = 9000
+# names of the sources scanned by "create" besides the input files
+SOURCE_NAME = re.compile(r'^[A-Za-z0-9_.-]+$')
+DEFAULT_SOURCE_LABEL = 'input'
+# options of parameter show taking a value
+SHOW_OPTIONS = ('--min-size', '--min-parts', '--max-parts', '--clock',
+                '--blocks', '--min-rate', '--max-rate', '--stream',
+                '--max-clockless', '--sort', '--limit', '--offset')
+# how long a concurrent scan waits for the database locked by another one
+SHARED_DB_TIMEOUT = 60000
+# ids looked up per query (sqlite allows 999 parameters by default)
+MAX_QUERY_IDS = 500
+# increase whenever the scan results of the same input and settings change
+SCAN_CACHE_VERSION = 5
 
 
 class DvrRecoverError(Exception):
@@ -247,6 +588,10 @@ class ExportError(DvrRecoverError):
     '''Error while exporting chunks'''
     pass
 
+class ShowError(DvrRecoverError):
+    '''Invalid arguments of parameter show'''
+    pass
+
 class UnexpectedResultError(DvrRecoverError):
     '''Unexpected result encountered'''
     pass
@@ -255,6 +600,85 @@ class FileReaderError(DvrRecoverError):
     '''Exception class for FileReader class'''
     pass
 
+class RescueMapError(DvrRecoverError):
+    '''Error while reading ddrescue mapfile'''
+    pass
+
+
+
+def clock_delta(clock1, clock2):
+    '''Return ticks from clock1 forward to clock2, taking the wraparound of
+    the 33 bit clock into account (a step backwards gives a huge delta)'''
+    return (clock2 - clock1) % CLOCK_MODULUS
+
+
+
+def find_clocks(buf, chunk_format):
+    '''Return list of (position, clock) tuples of the pack headers (program
+    stream) or the packets with PCR (transport stream) in buf'''
+    clocks = []
+    if chunk_format == 'ps':
+        pos = buf.find(PACK_START_CODE)
+        while pos != -1:
+            clock = ChunkFactory.mpeg_header(buf, pos)
+            if clock is not None:
+                clocks.append((pos, clock))
+            pos = buf.find(PACK_START_CODE, pos + 1)
+        return clocks
+
+    # the packet layout is searched again behind data which is not part of
+    # the stream (e.g. at the end of a chunk)
+    pos = 0
+    while pos < len(buf):
+        layout = None
+        for size in TS_PACKET_SIZES:
+            start = buf.find(TS_SYNC_BYTE, pos, pos + size)
+            while (start != -1) and (layout is None):
+                if buf[start:start + 4 * size:size] == TS_SYNC_BYTE * 4:
+                    layout = (start, size)
+                else:
+                    start = buf.find(TS_SYNC_BYTE, start + 1, pos + size)
+            if layout is not None:
+                break
+        if layout is None:
+            pos += max(TS_PACKET_SIZES)
+            continue
+        pos, size = layout
+        while (pos + 12 <= len(buf)) and (buf[pos] == TS_SYNC_BYTE):
+            clock = ChunkFactory.ts_pcr(buf, pos)
+            if clock is not None:
+                clocks.append((pos, clock))
+            pos += size
+        if pos + 12 > len(buf):
+            break
+    return clocks
+
+
+
+def join_stream_ids(stream_ids):
+    '''Return PES stream ids as stored in the database (e.g. "c0,e0")'''
+    return ','.join(['%02x' % stream_id for stream_id in sorted(stream_ids)])
+
+
+
+def split_stream_ids(value):
+    '''Return set of PES stream ids stored by join_stream_ids'''
+    return set([int(item, 16) for item in value.split(',') if item != ''])
+
+
+
+def parse_io_priority(value):
+    '''Return ioprio value of setting io_priority ("none", "idle",
+    "best-effort:LEVEL" or "realtime:LEVEL") or None for "none", raise
+    ValueError if the value is invalid'''
+    if value == 'none':
+        return None
+    name, level = (value.split(':', 1) + ['4'])[:2]
+    level = int(level)
+    if (name not in IO_PRIORITY_CLASSES) or not (0 <= level <= 7):
+        raise ValueError('Invalid I/O priority: %s' % value)
+    return (IO_PRIORITY_CLASSES[name] << 13) | level
+
 
 
 class Chunk(object):
@@ -265,6 +689,15 @@ class Chunk(object):
                  'clock_start',
                  'clock_end',
                  'concat',
+                 'byte_start',
+                 'byte_size',
+                 'format',
+                 'duplicate',
+                 'source',
+                 'chain',
+                 'byte_rate',
+                 'stream_ids',
+                 'clockless_blocks',
                  'new')
 
     def __init__(self, new = True):
@@ -273,6 +706,26 @@ class Chunk(object):
         self.new = new
 
 
+    def extent(self, blocksize):
+        '''Return (offset, size) of the chunk in bytes'''
+        if self.byte_start is not None:
+            return (self.byte_start, self.byte_size)
+        return (self.block_start * blocksize, self.block_size * blocksize)
+
+
+    def set_stats(self, stream_ids, headers, blocksize):
+        '''Set stream statistics from the set of PES stream ids and the count
+        of headers with clock found in the chunk'''
+        self.stream_ids = join_stream_ids(stream_ids)
+        self.clockless_blocks = max(self.block_size - headers, 0)
+        size = self.extent(blocksize)[1]
+        duration = clock_delta(self.clock_start, self.clock_end)
+        if duration > 0:
+            self.byte_rate = size * CLOCK_FREQUENCY // duration
+        else:
+            self.byte_rate = None
+
+
 
 class Timer(object):
     '''Time measurement'''
@@ -294,20 +747,600 @@ class Timer(object):
 
 
 
+class RateLimiter(object):
+    '''Token bucket limiting the rate of the data read from the input
+
+    rate is given in MiB/s, 0 means unlimited. While the program is running
+    the rate and the I/O priority are taken from the control file as soon
+    as it changes. It contains lines like "io_rate 20" or "io_priority
+    idle". A control file written before started (default: now) is left
+    over from an earlier run and ignored.
+
+    Processes reading at the same time share the rate: pass them the same
+    bucket returned by create_bucket.'''
+    __slots__ = ('rate', 'bucket', 'lock', 'control_file', 'control_mtime',
+                 'started', 'checked')
+
+    def __init__(self, rate, priority, control_file=IO_CONTROL_FILE,
+                 bucket=None, started=None):
+        self.rate = 0.0
+        if bucket is None:
+            # tokens, time of the last update
+            self.bucket = [0.0, time.time()]
+            self.lock = None
+        else:
+            self.bucket = bucket
+            self.lock = bucket.get_lock()
+        if started is None:
+            started = time.time()
+        self.started = started
+        self.checked = time.time()
+        self.control_file = control_file
+        self.control_mtime = None
+        self.set_rate(rate)
+        self.set_priority(priority)
+        self.check_control()
+
+
+    @staticmethod
+    def create_bucket():
+        '''Return bucket to be shared by the RateLimiter objects of several
+        processes'''
+        return multiprocessing.Array('d', [0.0, time.time()])
+
+
+    def set_rate(self, rate):
+        '''Set rate in MiB/s'''
+        self.rate = float(rate) * 1024**2
+        if self.lock is not None:
+            self.lock.acquire()
+        try:
+            self.bucket[0] = min(self.bucket[0], self.rate)
+        finally:
+            if self.lock is not None:
+                self.lock.release()
+
+
+    def set_priority(self, priority):
+        '''Set I/O priority of the process by value of setting io_priority'''
+        ioprio = parse_io_priority(priority)
+        if ioprio is None:
+            return
+        if ioprio_set is None:
+            print 'Warning: I/O priority is not supported on this system.'
+            return
+        try:
+            ioprio_set(ioprio)
+        except OSError, e:
+            print 'Warning: Setting I/O priority failed: %s' % e.strerror
+
+
+    def check_control(self):
+        '''Take over rate and priority of the control file if it has
+        changed'''
+        try:
+            mtime = os.stat(self.control_file).st_mtime
+        except OSError:
+            return
+        if (mtime < self.started) or (mtime == self.control_mtime):
+            return
+        self.control_mtime = mtime
+        f = open(self.control_file, 'r')
+        try:
+            for line in f:
+                args = line.split()
+                if len(args) == 0:
+                    continue
+                try:
+                    if (args[0] == 'io_rate') and (len(args) == 2):
+                        self.set_rate(args[1])
+                        print 'I/O rate set to %s MiB/s.' % args[1]
+                    elif (args[0] == 'io_priority') and (len(args) == 2):
+                        self.set_priority(args[1])
+                        print 'I/O priority set to %s.' % args[1]
+                    else:
+                        raise ValueError
+                except ValueError:
+                    print 'Warning: Invalid line in %s: %s' % \
+                          (self.control_file, line.strip())
+        finally:
+            f.close()
+
+
+    def consume(self, count):
+        '''Take count bytes from the bucket, sleep if it is empty'''
+        now = time.time()
+        if now - self.checked >= IO_CONTROL_INTERVAL:
+            self.checked = now
+            self.check_control()
+        if self.lock is not None:
+            self.lock.acquire()
+        try:
+            if self.rate <= 0:
+                self.bucket[1] = now
+                return
+            # the bucket holds the data of at most one second
+            tokens = min(self.bucket[0] +
+                         max(now - self.bucket[1], 0) * self.rate,
+                         self.rate)
+            self.bucket[0] = tokens - count
+            self.bucket[1] = max(now, self.bucket[1])
+            delay = -self.bucket[0] / self.rate
+        finally:
+            if self.lock is not None:
+                self.lock.release()
+        if delay > 0:
+            time.sleep(delay)
+
+
+
+class CompressedFile(object):
+    '''Seekable file object for gzip or xz compressed input files
+
+    The uncompressed size is unknown until the file has been decompressed
+    once; the first pass is done by the first reads behind the data known so
+    far (e.g. the scan of "create"). It builds a seek index: the starts of
+    gzip members and xz streams, the full flush points of gzip members (e.g.
+    written by "pigz --independent") and periodic copies of the decompressor
+    state are stored as checkpoints. A seek restarts the decompression at
+    the nearest checkpoint in front of the target.
+
+    The decompressor state can't be saved, all other checkpoints and the
+    size are stored in the database when the end of the file is reached.
+    Later runs load them instead of decompressing the file again.'''
+    __slots__ = ('filename', 'compression', 'file', 'decompressor', 'raw',
+                 'position', 'buffer', 'buffer_pos', 'decoded', 'known',
+                 'size', 'checkpoints', 'interval', 'finished', 'db_manager',
+                 'file_size', 'mtime', 'candidate', 'flush_misses')
+
+    def __init__(self, filename, compression, db_manager=None):
+        if (compression == 'xz') and (lzma is None):
+            raise FileReaderError('Module lzma is required to read xz '
+                                  'compressed input files.')
+        self.filename = filename
+        self.compression = compression
+        self.file = None
+        self.decompressor = None
+        self.raw = False
+        self.position = 0
+        self.buffer = ''
+        self.buffer_pos = 0
+        self.decoded = 0
+        self.known = 0
+        self.size = None
+        # (position, offset, decompressor state, raw) sorted by position
+        self.checkpoints = [(0, 0, None, False)]
+        self.interval = CHECKPOINT_INTERVAL
+        self.finished = False
+        self.db_manager = db_manager
+        stat = os.stat(filename)
+        self.file_size = stat.st_size
+        self.mtime = stat.st_mtime
+        # flush point being verified: [position, offset, decompressor,
+        # length of the data verified]
+        self.candidate = None
+        self.flush_misses = 0
+        if db_manager is not None:
+            self.load_index()
+
+
+    def load_index(self):
+        '''Load checkpoints and size saved by an earlier run'''
+        rows = self.db_manager.compressed_index_query(self.filename,
+                                                      self.file_size,
+                                                      self.mtime)
+        for position, offset, kind in rows:
+            if kind == 'end':
+                self.size = position
+                self.known = position
+            elif position > 0:
+                self.checkpoints.append((position, offset, None,
+                                         kind == 'flush'))
+
+
+    def save_index(self):
+        '''Save checkpoints without decompressor state and the size'''
+        if self.db_manager is None:
+            return
+        rows = []
+        for position, offset, state, raw in self.checkpoints:
+            if state is None:
+                rows.append((position, offset, raw and 'flush' or 'member'))
+        rows.append((self.size, self.file_size, 'end'))
+        self.db_manager.compressed_index_save(self.filename, self.file_size,
+                                              self.mtime, rows)
+
+
+    def get_size(self):
+        '''Return uncompressed size or the size of the data decompressed so
+        far if the end hasn't been reached yet'''
+        if self.size is not None:
+            return self.size
+        return self.known
+
+
+    def new_decompressor(self, raw=False):
+        '''Return decompressor for the start of a gzip member/xz stream or
+        (raw) for the deflate data behind a full flush point'''
+        if raw:
+            return zlib.decompressobj(-zlib.MAX_WBITS)
+        if self.compression == 'gzip':
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return lzma.LZMADecompressor()
+
+
+    def needs_checkpoint(self, position, saved):
+        '''Return true if there is no checkpoint nearby in front of
+        position; checkpoints to be saved only consider saved ones'''
+        if saved:
+            positions = [item[0] for item in self.checkpoints
+                         if item[2] is None]
+            distance = CHECKPOINT_INTERVAL
+        else:
+            positions = [item[0] for item in self.checkpoints]
+            distance = self.interval
+        index = bisect.bisect_right(positions, position)
+        return position - positions[index - 1] >= distance
+
+
+    def add_checkpoint(self, position, offset, state, raw):
+        '''Remember decompressor state (None: start of a new decompressor)
+        at compressed offset, unless there is a checkpoint nearby'''
+        if not self.needs_checkpoint(position, state is None):
+            return
+        positions = [item[0] for item in self.checkpoints]
+        index = bisect.bisect_right(positions, position)
+        self.checkpoints.insert(index, (position, offset, state, raw))
+        copies = [item for item in self.checkpoints if item[2] is not None]
+        if len(copies) > MAX_CHECKPOINTS:
+            # keep memory usage bounded: halve the density of the copies
+            dropped = set([id(item) for item in copies[1::2]])
+            self.checkpoints = [item for item in self.checkpoints
+                                if id(item) not in dropped]
+            self.interval *= 2
+
+
+    def restore(self, checkpoint):
+        '''Continue decompression at checkpoint'''
+        position, offset, state, raw = checkpoint
+        if self.file is None:
+            self.file = open(self.filename, 'rb')
+        self.file.seek(offset)
+        if state is None:
+            self.decompressor = self.new_decompressor(raw)
+        else:
+            self.decompressor = state.copy()
+        self.raw = raw
+        self.position = position
+        self.buffer = ''
+        self.buffer_pos = 0
+        self.decoded = position
+        self.finished = False
+        self.candidate = None
+
+
+    def next_stream(self, offset):
+        '''Return offset of the gzip member/xz stream starting at offset
+        (behind the stream padding of xz) or None'''
+        self.file.seek(offset)
+        if self.compression == 'xz':
+            while self.file.read(4) == '\x00\x00\x00\x00':
+                offset += 4
+            self.file.seek(offset)
+            magic = XZ_MAGIC
+        else:
+            magic = GZIP_MAGIC
+        if self.file.read(len(magic)) != magic:
+            return None
+        self.file.seek(offset)
+        return offset
+
+
+    def flush_point(self, data):
+        '''Return index behind a possible full flush point in data or None'''
+        if ((self.compression != 'gzip') or (self.size is not None) or
+            (self.decoded < self.known) or (self.candidate is not None) or
+            (self.flush_misses >= FLUSH_POINT_ATTEMPTS) or
+            not self.needs_checkpoint(self.decoded, True)):
+            return None
+        # a flush ends with an empty stored block: 00 00 ff ff
+        index = data.find(FLUSH_MARKER)
+        if index == -1:
+            return None
+        return index + len(FLUSH_MARKER)
+
+
+    def verify_flush_point(self, data, result):
+        '''Check the decompressor started behind the flush point candidate
+        with the compressed data and its result'''
+        position, offset, decompressor, verified = self.candidate
+        try:
+            output = decompressor.decompress(data)
+        except zlib.error:
+            output = None
+        if output != result:
+            # just a sync flush (or a random match): the data behind it
+            # refers to the data in front of it
+            self.candidate = None
+            self.flush_misses += 1
+            return
+        self.candidate[3] += len(result)
+        if ((self.candidate[3] >= FLUSH_POINT_VERIFY) or
+            (len(decompressor.unused_data) > 0)):
+            # nothing behind the window of the deflate data refers to the
+            # data in front of the flush point
+            self.add_checkpoint(position, offset, None, True)
+            self.candidate = None
+            self.flush_misses = 0
+
+
+    def decompress_next(self):
+        '''Return next piece of decompressed data ('' at end of file)'''
+        while not self.finished:
+            start = self.file.tell()
+            data = self.file.read(COMPRESSED_READ_SIZE)
+            if len(data) == 0:
+                self.finished = True
+                break
+            split = self.flush_point(data)
+            if split is None:
+                result = self.decompressor.decompress(data)
+                used = len(data)
+                if self.candidate is not None:
+                    self.verify_flush_point(data, result)
+            else:
+                result = self.decompressor.decompress(data[:split])
+                used = split
+                if len(self.decompressor.unused_data) == 0:
+                    self.candidate = [self.decoded + len(result),
+                                      start + split,
+                                      self.new_decompressor(True), 0]
+                    rest = self.decompressor.decompress(data[split:])
+                    self.verify_flush_point(data[split:], rest)
+                    result += rest
+                    used = len(data)
+            unused = self.decompressor.unused_data
+            if len(unused) > 0:
+                # end of gzip member/xz stream, another one may follow
+                offset = start + used - len(unused)
+                if self.raw:
+                    # behind the deflate data: CRC32 and size of the member
+                    offset += 8
+                offset = self.next_stream(offset)
+                if offset is None:
+                    # trailing garbage, ignore it
+                    self.finished = True
+                else:
+                    self.decompressor = self.new_decompressor()
+                    self.raw = False
+                    self.candidate = None
+                    self.add_checkpoint(self.decoded + len(result), offset,
+                                        None, False)
+            elif ((self.compression == 'gzip') and
+                  self.needs_checkpoint(self.decoded + len(result), False)):
+                self.add_checkpoint(self.decoded + len(result),
+                                    self.file.tell(),
+                                    self.decompressor.copy(), self.raw)
+            self.decoded += len(result)
+            self.known = max(self.known, self.decoded)
+            if len(result) > 0:
+                return result
+        if self.size is None:
+            self.size = self.decoded
+            self.known = self.decoded
+            self.save_index()
+        return ''
+
+
+    def extend(self):
+        '''Decompress the next piece of data behind the data known so far'''
+        if self.size is not None:
+            return
+        if ((self.file is None) or
+            (self.position + len(self.buffer) - self.buffer_pos !=
+             self.known)):
+            self.seek(self.known)
+        data = self.decompress_next()
+        # keep the end of the data not read yet (e.g. the rest of the last
+        # block scanned), the next read seeks anyway
+        drop = max(len(self.buffer) - self.buffer_pos - SCAN_BUFFER_SIZE, 0)
+        self.position += drop
+        self.buffer = self.buffer[self.buffer_pos + drop:] + data
+        self.buffer_pos = 0
+
+
+    def tell(self):
+        '''Return current position in uncompressed data'''
+        return self.position
+
+
+    def seek(self, offset):
+        '''Seek to offset in uncompressed data'''
+        checkpoint = self.checkpoints[0]
+        for item in self.checkpoints:
+            if item[0] > offset:
+                break
+            checkpoint = item
+        if ((self.file is None) or (offset < self.position) or
+            (checkpoint[0] > self.position)):
+            self.restore(checkpoint)
+        while self.position < offset:
+            if self.buffer_pos == len(self.buffer):
+                self.buffer = self.decompress_next()
+                self.buffer_pos = 0
+                if len(self.buffer) == 0:
+                    break
+            skip = min(offset - self.position,
+                       len(self.buffer) - self.buffer_pos)
+            self.buffer_pos += skip
+            self.position += skip
+
+
+    def read(self, size):
+        '''Read up to size bytes of uncompressed data'''
+        if self.file is None:
+            self.seek(self.position)
+        pieces = []
+        length = 0
+        while length < size:
+            if self.buffer_pos == len(self.buffer):
+                self.buffer = self.decompress_next()
+                self.buffer_pos = 0
+                if len(self.buffer) == 0:
+                    break
+            piece = self.buffer[self.buffer_pos:
+                                self.buffer_pos + size - length]
+            self.buffer_pos += len(piece)
+            pieces.append(piece)
+            length += len(piece)
+        self.position += length
+        return ''.join(pieces)
+
+
+    def readinto(self, view):
+        '''Read uncompressed data into writable buffer'''
+        data = self.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+
+    def close(self):
+        '''Close compressed file (the seek index is kept)'''
+        if self.file is not None:
+            self.file.close()
+        self.file = None
+
+
+
+class RescueMap(object):
+    '''Regions and their status read from a GNU ddrescue mapfile
+
+    Only regions with status "+" (finished) contain rescued data. Regions
+    beyond the end of the mapfile are handled as non-tried.'''
+    __slots__ = ('filename', 'current_status', 'regions')
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.current_status = None
+        self.regions = []
+        self.load()
+
+
+    def load(self):
+        '''Read mapfile'''
+        current_status = None
+        regions = []
+        try:
+            f = open(self.filename, 'r')
+            try:
+                for line in f:
+                    fields = line.split('#', 1)[0].split()
+                    if len(fields) == 0:
+                        continue
+                    if current_status is None:
+                        # status line: current_pos current_status [pass]
+                        current_status = fields[1]
+                        continue
+                    start = int(fields[0], 0)
+                    end = start + int(fields[1], 0)
+                    if ((len(regions) == 0 and start != 0) or
+                        (len(regions) > 0 and regions[-1][1] != start)):
+                        raise RescueMapError('Regions of mapfile are not '
+                                             'contiguous.')
+                    regions.append((start, end, fields[2]))
+            finally:
+                f.close()
+        except (IOError, IndexError, ValueError), e:
+            raise RescueMapError('Invalid mapfile %s: %s' %
+                                 (self.filename, e))
+        if current_status is None:
+            raise RescueMapError('Invalid mapfile %s: status line is '
+                                 'missing.' % self.filename)
+        self.current_status = current_status
+        self.regions = regions
+
+
+    def get_end(self):
+        '''Return end of last region in mapfile'''
+        if len(self.regions) == 0:
+            return 0
+        return self.regions[-1][1]
+
+
+    def is_running(self):
+        '''Return true if ddrescue has not finished yet'''
+        return self.current_status != '+'
+
+
+    def filter_extents(self, extents):
+        '''Return intersection of extents and finished regions'''
+        result = []
+        for start, end, status in self.regions:
+            if status != '+':
+                continue
+            for extent_start, extent_end in extents:
+                extent_start = max(start, extent_start)
+                extent_end = min(end, extent_end)
+                if extent_start >= extent_end:
+                    continue
+                if (len(result) > 0) and (result[-1][1] == extent_start):
+                    result[-1] = (result[-1][0], extent_end)
+                else:
+                    result.append((extent_start, extent_end))
+        return result
+
+
+    def pending_offset(self, offset):
+        '''Return start of first non-tried region behind offset or None if
+        ddrescue won't read more data behind offset'''
+        if not self.is_running():
+            return None
+        for start, end, status in self.regions:
+            if (status == '?') and (end > offset):
+                return max(start, offset)
+        return max(self.get_end(), offset)
+
+
+    def is_damaged(self, start, end):
+        '''Return true if region overlaps or borders not finished areas'''
+        if end > self.get_end():
+            return True
+        if (end == self.get_end()) and self.is_running():
+            # ddrescue may still extend the mapfile
+            return True
+        for region_start, region_end, status in self.regions:
+            if ((status != '+') and
+                (region_start <= end) and (region_end >= start)):
+                return True
+        return False
+
+
+
 class FileReader(object):
-    '''Handle multiple input streams as one big file'''
-    __slots__ = ('parts', 'current_file', 'file')
+    '''Handle multiple input streams as one big file
 
-    def __init__(self, filenames):
-        '''Initialize FileReader'''
+    The size of a compressed part is unknown until it has been decompressed
+    once (unless the database contains its seek index). Only the parts up to
+    the first one of unknown size are visible, extend decompresses more of
+    it.'''
+    __slots__ = ('parts', 'current_file', 'file', 'rescue_map', 'limiter')
+
+    def __init__(self, filenames, db_manager=None):
+        '''Initialize FileReader, the seek indexes of compressed parts are
+        stored in the database of db_manager'''
         self.parts = []
         for filename in filenames:
             if filename[0:3] == r'\\.':
                 raise FileReaderError('Direct access to Windows devices files '
                                       'is not supported currently.')
             part = {'filename': filename,
-                    'size': os.stat(filename).st_size}
-            if part['size'] == 0:
+                    'size': os.stat(filename).st_size,
+                    'stream': None}
+            compression = self.detect_compression(filename)
+            if compression is not None:
+                part['stream'] = CompressedFile(filename, compression,
+                                                db_manager)
+            elif part['size'] == 0:
                 # size is most likely not 0, but it might be a special file
                 # (device file). Try to determine size in another way.
                 f = open(part['filename'], 'rb')
@@ -317,22 +1350,168 @@ class FileReader(object):
             self.parts.append(part)
         self.current_file = None
         self.file = None
+        self.rescue_map = None
+        self.limiter = None
+
+
+    def detect_compression(self, filename):
+        '''Return compression of file detected by its magic or None'''
+        f = open(filename, 'rb')
+        magic = f.read(len(XZ_MAGIC))
+        f.close()
+        if magic[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+            return 'gzip'
+        if magic == XZ_MAGIC:
+            return 'xz'
+        return None
+
+
+    def get_part_size(self, part):
+        '''Return size of a part, of a compressed part of unknown size the
+        size of the data decompressed so far'''
+        if part['stream'] is not None:
+            return part['stream'].get_size()
+        return part['size']
+
+
+    def get_parts(self):
+        '''Return parts up to the first one of unknown size'''
+        for index, part in enumerate(self.parts):
+            if (part['stream'] is not None) and (part['stream'].size is None):
+                return self.parts[:index + 1]
+        return self.parts
+
+
+    def complete(self):
+        '''Return true if the sizes of all parts are known'''
+        for part in self.parts:
+            if (part['stream'] is not None) and (part['stream'].size is None):
+                return False
+        return True
+
+
+    def extend(self):
+        '''Decompress the next piece of the first part of unknown size'''
+        part = self.get_parts()[-1]
+        if part['stream'] is not None:
+            part['stream'].extend()
+
+
+    def build_index(self):
+        '''Decompress all parts of unknown size'''
+        while not self.complete():
+            self.extend()
 
 
     def get_size(self):
-        '''Return the total size of all input streams'''
+        '''Return the total size of all visible input streams'''
         size = 0
-        for part in self.parts:
-            size += part['size']
+        for part in self.get_parts():
+            size += self.get_part_size(part)
         return size
 
 
+    def refresh(self):
+        '''Update the size of the last input file, return True if it has
+        grown'''
+        part = self.parts[-1]
+        if part['stream'] is not None:
+            return False
+        size = os.stat(part['filename']).st_size
+        if size <= part['size']:
+            return False
+        part['size'] = size
+        return True
+
+
+    def get_part_extents(self, part):
+        '''Return list of (start, end) tuples of the data in a file part'''
+        if (part['stream'] is not None) or (SEEK_DATA is None):
+            return [(0, self.get_part_size(part))]
+        extents = []
+        fd = os.open(part['filename'], os.O_RDONLY)
+        try:
+            offset = 0
+            while offset < part['size']:
+                try:
+                    start = os.lseek(fd, offset, SEEK_DATA)
+                except OSError, e:
+                    if e.errno == errno.ENXIO:
+                        # no more data behind offset
+                        break
+                    # holes are not supported by file (system)
+                    return [(0, part['size'])]
+                end = min(os.lseek(fd, start, SEEK_HOLE), part['size'])
+                if start >= end:
+                    break
+                extents.append((start, end))
+                offset = end
+        finally:
+            os.close(fd)
+        return extents
+
+
+    def get_data_extents(self):
+        '''Return list of (start, end) tuples of all regions containing data,
+        holes of sparse files and regions not rescued by ddrescue are left
+        out'''
+        extents = []
+        offset = 0
+        for part in self.get_parts():
+            for start, end in self.get_part_extents(part):
+                start += offset
+                end += offset
+                if (len(extents) > 0) and (extents[-1][1] == start):
+                    extents[-1] = (extents[-1][0], end)
+                else:
+                    extents.append((start, end))
+            offset += self.get_part_size(part)
+        if self.rescue_map is not None:
+            extents = self.rescue_map.filter_extents(extents)
+        return extents
+
+
+    def get_fingerprint(self, blocksize):
+        '''Return hash of the sizes of all parts and sampled blocks, the
+        blocks of compressed parts are sampled without decompressing them'''
+        fingerprint = hashlib.sha1()
+        if len([part for part in self.parts
+                if part['stream'] is not None]) > 0:
+            for part in self.parts:
+                if part['stream'] is not None:
+                    size = part['stream'].file_size
+                    fingerprint.update('%s\0' % part['stream'].compression)
+                else:
+                    size = part['size']
+                fingerprint.update('%i\0' % size)
+                f = open(part['filename'], 'rb')
+                try:
+                    self.sample_blocks(fingerprint, f, size, blocksize)
+                finally:
+                    f.close()
+            return fingerprint.hexdigest()
+        for part in self.parts:
+            fingerprint.update('%i\0' % part['size'])
+        self.sample_blocks(fingerprint, self, self.get_size(), blocksize)
+        return fingerprint.hexdigest()
+
+
+    def sample_blocks(self, fingerprint, f, size, blocksize):
+        '''Add sampled blocks of file object f to fingerprint'''
+        blocks = size // blocksize
+        if blocks > 0:
+            for i in xrange(FINGERPRINT_SAMPLES):
+                block = (blocks - 1) * i // max(FINGERPRINT_SAMPLES - 1, 1)
+                f.seek(block * blocksize)
+                fingerprint.update(f.read(blocksize))
+
+
     def get_index(self, offset):
         '''Return the index of the file where offset is located'''
         index = 0
         start = 0
-        for part in self.parts:
-            end = start + part['size']
+        for part in self.get_parts():
+            end = start + self.get_part_size(part)
             if ((offset >= start) and
                 (offset < end)):
                 return index
@@ -347,7 +1526,7 @@ class FileReader(object):
         offset = 0
         for part in self.parts:
             if i < index:
-                offset += part['size']
+                offset += self.get_part_size(part)
             else:
                 break
             i += 1
@@ -358,7 +1537,11 @@ class FileReader(object):
         '''Open input stream with the specified index'''
         self.close()
         if (index >= 0) and (index < len(self.parts)):
-            self.file = open(self.parts[index]['filename'], 'rb')
+            if self.parts[index]['stream'] is not None:
+                self.file = self.parts[index]['stream']
+                self.file.seek(0)
+            else:
+                self.file = open(self.parts[index]['filename'], 'rb')
             self.current_file = index
         else:
             raise FileReaderError('Index out of range!')
@@ -374,6 +1557,8 @@ class FileReader(object):
 
     def seek(self, offset):
         '''Seek to offset (open correct file, seek, ...)'''
+        while (self.get_index(offset) is None) and not self.complete():
+            self.extend()
         index = self.get_index(offset)
         delta = offset - self.get_offset(index)
         if self.current_file is None:
@@ -386,7 +1571,8 @@ class FileReader(object):
 
     def is_eof(self):
         '''Return true if eof of current file part is reached'''
-        return (self.file.tell() == self.parts[self.current_file]['size'])
+        return (self.file.tell() ==
+                self.get_part_size(self.parts[self.current_file]))
 
 
     def next_file(self):
@@ -401,6 +1587,8 @@ class FileReader(object):
         '''Read data from stream, automatically switch stream if necessary'''
         if self.file is None:
             raise FileReaderError('No files are open!')
+        if self.limiter is not None:
+            self.limiter.consume(size)
         buf = self.file.read(size)
         delta = size - len(buf)
         if delta != 0:
@@ -413,14 +1601,53 @@ class FileReader(object):
         return buf
 
 
+    def readinto(self, view):
+        '''Read data into writable buffer (e.g. memoryview of a bytearray)
+        without copying it, automatically switch stream if necessary'''
+        if self.file is None:
+            raise FileReaderError('No files are open!')
+        if self.limiter is not None:
+            self.limiter.consume(len(view))
+        count = self.file.readinto(view)
+        if count != len(view):
+            if self.is_eof():
+                self.next_file()
+                count += self.readinto(view[count:])
+            else:
+                raise FileReaderError('Incomplete filled buffer without '
+                                      'reaching end of file!')
+        return count
+
+
 
 class SqlManager(object):
-    '''Interface to access data via SQL queries'''
-    __slots__ = ('conn',)
+    '''Interface to access data via SQL queries
+
+    The methods used by the scanners (state, header runs, counting and
+    deleting chunks) only see the rows of the source set in attribute
+    source; None is the source of the input files.'''
+    __slots__ = ('conn', 'source')
+
+    chunk_columns = ('id',
+                     'block_start',
+                     'block_size',
+                     'clock_start',
+                     'clock_end',
+                     'concat',
+                     'byte_start',
+                     'byte_size',
+                     'format',
+                     'duplicate',
+                     'source',
+                     'chain',
+                     'byte_rate',
+                     'stream_ids',
+                     'clockless_blocks')
 
     def __init__(self):
         '''Initialize SqlManager'''
         self.conn = None
+        self.source = None
 
 
     def open(self, filename):
@@ -429,6 +1656,35 @@ class SqlManager(object):
         self.init_db()
 
 
+    def share(self, source):
+        '''Bind connection to the scan of source, running concurrently with
+        the scans of other sources or other parameters (e.g. "sort" while
+        "survey" is running)
+
+        Every change is committed immediately (unless a transaction is
+        started explicitly by begin), so the others are never blocked for
+        long. With the write-ahead log readers don't block the scan at all;
+        a crash may lose the last commits, but the scan resumes at the
+        last saved state anyway.'''
+        self.source = source
+        self.conn.isolation_level = None
+        self.conn.execute("PRAGMA busy_timeout = %i" % SHARED_DB_TIMEOUT)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+
+
+    def begin(self):
+        '''Start a transaction on a shared connection'''
+        if self.conn.isolation_level is None:
+            self.conn.execute("BEGIN")
+
+
+    def snapshot(self):
+        '''Start a read transaction, so all following queries see the same
+        state of the database while a scan is adding chunks'''
+        self.conn.execute("BEGIN")
+
+
     def close(self, commit=True):
         '''Close database connection after optional commit'''
         if commit:
@@ -452,11 +1708,75 @@ class SqlManager(object):
                 "clock_end INTEGER,"
                 "concat INTEGER"
             ")")
+        self.add_columns('chunk', (('byte_start', 'INTEGER'),
+                                   ('byte_size', 'INTEGER'),
+                                   ('format', 'TEXT'),
+                                   ('duplicate', 'INTEGER'),
+                                   ('source', 'TEXT'),
+                                   ('chain', 'INTEGER'),
+                                   ('byte_rate', 'INTEGER'),
+                                   ('stream_ids', 'TEXT'),
+                                   ('clockless_blocks', 'INTEGER')))
+        self.conn.execute("UPDATE chunk SET format = 'ps' "
+                          "WHERE format IS NULL")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS chunk_concat ON chunk (concat)")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS chunk_chain ON chunk (chain)")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS chunk_order "
+            "ON chunk (clock_start, source, block_start, byte_start, id)")
+        if self.conn.execute("SELECT COUNT(*) FROM chunk "
+                             "WHERE chain IS NULL").fetchone()[0] > 0:
+            self.chunk_update_chains()
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS header_run("
+                "id INTEGER PRIMARY KEY,"
+                "block_start INTEGER,"
+                "block_end INTEGER,"
+                "byte_start INTEGER,"
+                "byte_end INTEGER,"
+                "clock_start INTEGER,"
+                "clock_end INTEGER,"
+                "max_delta INTEGER"
+            ")")
+        self.add_columns('header_run', (('format', 'TEXT'),
+                                        ('source', 'TEXT'),
+                                        ('stream_ids', 'TEXT'),
+                                        ('headers', 'INTEGER')))
+        self.conn.execute("UPDATE header_run SET format = 'ps' "
+                          "WHERE format IS NULL")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS header_run_block_start "
+            "ON header_run (block_start)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS region("
+                "id INTEGER PRIMARY KEY,"
+                "block_start INTEGER,"
+                "block_end INTEGER,"
+                "probes INTEGER,"
+                "hits INTEGER,"
+                "clock_start INTEGER,"
+                "clock_end INTEGER,"
+                "done INTEGER"
+            ")")
         self.conn.execute(
             "CREATE TABLE IF NOT EXISTS state("
                 "key TEXT PRIMARY KEY ON CONFLICT REPLACE,"
                 "value"
             ")")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS compressed_index("
+                "filename TEXT,"
+                "file_size INTEGER,"
+                "mtime REAL,"
+                "position INTEGER,"
+                "offset INTEGER,"
+                "kind TEXT"
+            ")")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS compressed_index_filename "
+            "ON compressed_index (filename)")
         self.conn.execute(
             "CREATE TABLE IF NOT EXISTS setting("
                 "key TEXT PRIMARY KEY ON CONFLICT REPLACE,"
@@ -464,59 +1784,67 @@ class SqlManager(object):
             ")")
 
 
+    def add_columns(self, table, columns):
+        '''Add columns missing in databases created by older versions'''
+        existing = [row[1] for row in
+                    self.conn.execute("PRAGMA table_info(%s)" % table)]
+        for name, declaration in columns:
+            if name not in existing:
+                self.conn.execute("ALTER TABLE %s ADD COLUMN %s %s" %
+                                  (table, name, declaration))
+
+
     def chunk_count(self):
-        '''Return count of rows in chunk table'''
-        return self.conn.execute("SELECT COUNT(*) FROM chunk").fetchone()[0]
+        '''Return count of chunks of the source'''
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM chunk "
+            "WHERE source IS ?",
+            (self.source,)).fetchone()[0]
 
 
     def chunk_load(self, chunk_id):
         '''Return chunk object by chunk_id'''
         result = self.conn.execute(
-            "SELECT * FROM chunk "
-            "WHERE id = ?",
+            "SELECT %s FROM chunk "
+            "WHERE id = ?" % ', '.join(self.chunk_columns),
             (chunk_id,)).fetchone()
         if result is None:
             return None
         chunk = Chunk(False)
-        (chunk.id,
-         chunk.block_start,
-         chunk.block_size,
-         chunk.clock_start,
-         chunk.clock_end,
-         chunk.concat) = result
+        for column, value in zip(self.chunk_columns, result):
+            setattr(chunk, column, value)
         return chunk
 
 
     def chunk_save(self, chunk):
         '''Insert or update info in chunk table'''
+        if chunk.new and (chunk.source is None):
+            chunk.source = self.source
+        values = [getattr(chunk, column) for column in self.chunk_columns]
         if chunk.new:
             cur = self.conn.execute(
-                "INSERT INTO chunk "
-                "VALUES (?, ?, ?, ?, ?, ?)",
-                (chunk.id,
-                 chunk.block_start,
-                 chunk.block_size,
-                 chunk.clock_start,
-                 chunk.clock_end,
-                 chunk.concat))
+                "INSERT INTO chunk (%s) "
+                "VALUES (%s)" % (', '.join(self.chunk_columns),
+                                 ', '.join('?' * len(self.chunk_columns))),
+                values)
 
             chunk.id = cur.lastrowid
             chunk.new = False
+            if chunk.chain is None:
+                # every chunk starts a chain of its own
+                chunk.chain = chunk.id
+                self.conn.execute(
+                    "UPDATE chunk "
+                    "SET chain = id "
+                    "WHERE id = ?",
+                    (chunk.id,))
         else:
             self.conn.execute(
                 "UPDATE chunk "
-                "SET block_start = ?,"
-                    "block_size = ?,"
-                    "clock_start = ?,"
-                    "clock_end = ?,"
-                    "concat = ? "
-                "WHERE id = ?",
-                (chunk.block_start,
-                 chunk.block_size,
-                 chunk.clock_start,
-                 chunk.clock_end,
-                 chunk.concat,
-                 chunk.id))
+                "SET %s "
+                "WHERE id = ?" % ', '.join(['%s = ?' % column for column in
+                                             self.chunk_columns[1:]]),
+                values[1:] + [chunk.id])
 
 
     def chunk_delete_id(self, chunk_id):
@@ -539,17 +1867,186 @@ class SqlManager(object):
         '''Set concat to null for all rows in chunk table'''
         self.conn.execute(
             "UPDATE chunk "
-            "SET concat = null")
+            "SET concat = null, chain = id")
+
+
+    def chunk_update_chains(self):
+        '''Set chain of every chunk to the id of the first chunk of its
+        chain'''
+        self.conn.execute(
+            "UPDATE chunk "
+            "SET chain = id")
+        follower = {}
+        for chunk_id, concat in self.conn.execute(
+            "SELECT id, concat FROM chunk "
+            "WHERE concat IS NOT NULL"):
+            follower[concat] = chunk_id
+        updates = []
+        for head in set(follower) - set(follower.itervalues()):
+            chunk_id = follower[head]
+            while chunk_id is not None:
+                updates.append((head, chunk_id))
+                chunk_id = follower.get(chunk_id)
+        self.conn.executemany(
+            "UPDATE chunk "
+            "SET chain = ? "
+            "WHERE id = ?",
+            updates)
+
+
+    def chunk_reset_duplicate(self):
+        '''Set duplicate to null for all rows in chunk table'''
+        self.conn.execute(
+            "UPDATE chunk "
+            "SET duplicate = null")
+
+
+    def chunk_count_wrapped(self):
+        '''Return count of chunks of current source whose clock wraps
+        around'''
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM chunk "
+            "WHERE clock_end < clock_start AND "
+            "source IS ?",
+            (self.source,)).fetchone()[0]
+
+
+    def chunk_count_wrapped_concats(self):
+        '''Return count of chunks concatenated to a chunk across the
+        wraparound of the clock'''
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM chunk AS c "
+            "JOIN chunk AS p ON c.concat = p.id "
+            "WHERE c.clock_start < p.clock_end").fetchone()[0]
+
+
+    def chunk_count_duplicates(self):
+        '''Return count of chunks marked as duplicate'''
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM chunk "
+            "WHERE duplicate IS NOT NULL").fetchone()[0]
 
 
     def chunk_query_ids(self):
         '''Return iterator for all chunk ids'''
         for result in self.conn.execute(
             "SELECT id FROM chunk "
-            "ORDER BY clock_start"):
+            "ORDER BY clock_start, source, block_start, byte_start, id"):
             yield result[0]
 
 
+    def chunk_query_heads(self):
+        '''Return iterator for the ids of the first chunks of all chains in
+        the order of chunk_query_ids'''
+        for result in self.conn.execute(
+            "SELECT id FROM chunk "
+            "WHERE concat IS NULL "
+            "ORDER BY clock_start, source, block_start, byte_start, id"):
+            yield result[0]
+
+
+    # clock of the end of the chain relative to its start (modulo 2^33, a
+    # chain may continue across the wraparound of the clock)
+    chain_span = "MAX(((c.clock_end - head.clock_start) %% %i + %i) %% %i)" % \
+                 (CLOCK_MODULUS, CLOCK_MODULUS, CLOCK_MODULUS)
+
+    # the chain covers the clock from head.clock_start to head.clock_start +
+    # chain_span; clock_max expects (END, START or 0)
+    chain_filters = {'min_size': "SUM(c.block_size) >= ?",
+                     'min_parts': "COUNT(*) >= ?",
+                     'max_parts': "COUNT(*) <= ?",
+                     'clock_min': "head.clock_start + %s >= ?" % chain_span,
+                     'clock_max': "(head.clock_start <= ? OR "
+                                  "head.clock_start + %s - %i >= ?)" %
+                                  (chain_span, CLOCK_MODULUS),
+                     'block_min': "MAX(c.block_start + c.block_size) > ?",
+                     'block_max': "MIN(c.block_start) < ?",
+                     'min_rate': "MIN(c.byte_rate) >= ?",
+                     'max_rate': "MAX(c.byte_rate) <= ?",
+                     'stream': "MAX(',' || c.stream_ids || ',' "
+                                   "LIKE '%,' || ? || ',%')",
+                     'max_clockless': "SUM(c.clockless_blocks) <= ?"}
+
+    chain_orders = {'number': "head.clock_start, head.source, "
+                              "head.block_start, head.byte_start, head.id",
+                    'size': "size DESC, head.id",
+                    'parts': "parts DESC, head.id",
+                    'block': "head.source, block_start, head.id"}
+
+    def chain_having(self, filters):
+        '''Return HAVING clause and its parameters for dict filters (keys of
+        chain_filters)'''
+        clauses = []
+        params = []
+        for name, value in sorted(filters.iteritems()):
+            clauses.append(self.chain_filters[name])
+            if isinstance(value, tuple):
+                params.extend(value)
+            else:
+                params.append(value)
+        if len(clauses) == 0:
+            return ('', ())
+        return ('HAVING %s ' % ' AND '.join(clauses), tuple(params))
+
+
+    def chain_query(self, filters, order='number', limit=-1, offset=0):
+        '''Return iterator for tuples (id of first chunk, parts, size in
+        blocks, clock_start, clock_end, block_start, block_end) of the chains
+        matching filters'''
+        having, params = self.chain_having(filters)
+        for result in self.conn.execute(
+            "SELECT head.id, COUNT(*) AS parts, SUM(c.block_size) AS size, "
+                   "head.clock_start, (head.clock_start + %s) %% %i, "
+                   "MIN(c.block_start) AS block_start, "
+                   "MAX(c.block_start + c.block_size) "
+            "FROM chunk c INNER JOIN chunk head ON head.id = c.chain "
+            "GROUP BY c.chain "
+            "%s"
+            "ORDER BY %s "
+            "LIMIT ? OFFSET ?" % (self.chain_span, CLOCK_MODULUS, having,
+                                  self.chain_orders[order]),
+            params + (limit, offset)):
+            yield result
+
+
+    def chain_count(self, filters):
+        '''Return count of chains matching filters'''
+        having, params = self.chain_having(filters)
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM "
+             "("
+              "SELECT c.chain FROM chunk c "
+                "INNER JOIN chunk head ON head.id = c.chain "
+              "GROUP BY c.chain "
+              "%s"
+             ")" % having,
+            params).fetchone()[0]
+
+
+    def chunk_query_chain_ids(self, chunk_ids):
+        '''Return dict mapping each existing id of chunk_ids to the id of the
+        first chunk of its chain'''
+        chunk_ids = list(chunk_ids)
+        result = {}
+        for i in xrange(0, len(chunk_ids), MAX_QUERY_IDS):
+            batch = chunk_ids[i:i + MAX_QUERY_IDS]
+            for chunk_id, chain in self.conn.execute(
+                "SELECT id, chain FROM chunk "
+                "WHERE id IN (%s)" % ', '.join('?' * len(batch)),
+                batch):
+                result[chunk_id] = chain
+        return result
+
+
+    def chunk_query_chain_range(self, start, end):
+        '''Return set of the ids of the first chunks of the chains
+        containing chunks with ids from start to end'''
+        return set([row[0] for row in self.conn.execute(
+            "SELECT DISTINCT chain FROM chunk "
+            "WHERE id BETWEEN ? AND ?",
+            (start, end))])
+
+
     def chunk_query(self):
         '''Return iterator for all chunk objects'''
         for chunk_id in self.chunk_query_ids():
@@ -571,6 +2068,15 @@ class SqlManager(object):
         return self.chunk_load(result[0])
 
 
+    def chunk_query_chain(self, chunk):
+        '''Return list of chunk and all chunks concatenated to it'''
+        chain = []
+        while chunk is not None:
+            chain.append(chunk)
+            chunk = self.chunk_query_concat(chunk)
+        return chain
+
+
     def chunk_fix_multiple_concats(self):
         '''Fix multiple chunks referencing the same chunk in concat field'''
         self.conn.execute(
@@ -583,101 +2089,430 @@ class SqlManager(object):
              ")")
 
 
-    def state_reset(self):
-        '''Delete all entries of state table'''
-        self.conn.execute("DELETE FROM state")
+    def chunk_query_formats(self):
+        '''Return list of all formats of the chunks'''
+        return [row[0] for row in
+                self.conn.execute("SELECT DISTINCT format FROM chunk")]
 
 
-    def state_query(self, key):
-        '''Return value of state by key'''
-        result = self.conn.execute(
-            "SELECT value FROM state "
-            "WHERE key = ?",
-            (key,)).fetchone()
-        if result is None:
-            return None
-        return result[0]
+    def chunk_query_sources(self):
+        '''Return list of all sources of the chunks'''
+        return [row[0] for row in
+                self.conn.execute("SELECT DISTINCT source FROM chunk")]
 
 
-    def state_delete(self, key):
-        '''Delete entry in state table by key'''
+    def chunk_delete_range(self, block_start, block_end):
+        '''Delete all chunks of the source starting in the range of blocks'''
         self.conn.execute(
-            "DELETE from state "
-            "WHERE key = ?",
-            (key,))
+            "DELETE FROM chunk "
+            "WHERE block_start >= ? AND block_start < ? AND source IS ?",
+            (block_start, block_end, self.source))
 
 
-    def state_insert(self, key, value):
-        '''Insert key/value pair into state table'''
+    def chunk_delete_from(self, column, start):
+        '''Delete all chunks of the source starting at or behind start;
+        column is either block_start or byte_start'''
         self.conn.execute(
-            "INSERT INTO state "
-            "VALUES (?, ?)",
-            (key, value))
+            "DELETE FROM chunk "
+            "WHERE %s >= ? AND source IS ?" % column,
+            (start, self.source))
 
 
-    def setting_reset(self):
-        '''Delete all entries of setting table'''
-        self.conn.execute("DELETE FROM setting")
+    run_columns = ('block_start',
+                   'block_end',
+                   'byte_start',
+                   'byte_end',
+                   'clock_start',
+                   'clock_end',
+                   'max_delta',
+                   'format',
+                   'stream_ids',
+                   'headers')
 
+    def run_count(self):
+        '''Return count of rows in header_run table'''
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM header_run").fetchone()[0]
 
-    def setting_query(self, key):
-        '''Return value of setting by key'''
-        result = self.conn.execute(
-            "SELECT value FROM setting "
-            "WHERE key = ?",
-            (key,)).fetchone()
-        if result is None:
-            return None
-        return result[0]
 
+    def run_reset(self):
+        '''Delete all rows from header_run table'''
+        self.conn.execute("DELETE FROM header_run")
 
-    def setting_delete(self, key):
-        '''Delete entry in setting table by key'''
+
+    def run_delete_range(self, block_start, block_end):
+        '''Delete all header runs of the source starting in the range of
+        blocks'''
         self.conn.execute(
-            "DELETE from setting "
-            "WHERE key = ?",
-            (key,))
+            "DELETE FROM header_run "
+            "WHERE block_start >= ? AND block_start < ? AND source IS ?",
+            (block_start, block_end, self.source))
 
 
-    def setting_insert(self, key, value):
-        '''Insert key/value pair into setting table'''
+    def run_delete_from(self, column, start):
+        '''Delete all header runs of the source starting at or behind start;
+        column is either block_start or byte_start'''
         self.conn.execute(
-            "INSERT INTO setting "
-            "VALUES (?, ?)",
-            (key, value))
+            "DELETE FROM header_run "
+            "WHERE %s >= ? AND source IS ?" % column,
+            (start, self.source))
 
 
-class ChunkFactory(object):
-    '''Extract information of all chunks'''
-    __slots__ = ('current_block', 'clock', 'old_clock', 'timer', 'timer_all',
-                 'timer_blocks', 'blocksize', 'min_chunk_size', 'max_gap',
-                 'db_manager', 'reader', 'input_blocks', 'chunk')
+    def run_insert(self, run):
+        '''Insert run (tuple of values of run_columns) of the source into
+        header_run table'''
+        self.conn.execute(
+            "INSERT INTO header_run (%s, source) "
+            "VALUES (%s, ?)" % (', '.join(self.run_columns),
+                                ', '.join('?' * len(self.run_columns))),
+            tuple(run) + (self.source,))
+
+
+    def run_query(self):
+        '''Return iterator for all header runs (tuples of values of
+        run_columns) of the source ordered by position'''
+        for result in self.conn.execute(
+            "SELECT %s FROM header_run "
+            "WHERE source IS ? "
+            "ORDER BY block_start, byte_start" % ', '.join(self.run_columns),
+            (self.source,)):
+            yield result
+
+
+    def run_query_sources(self):
+        '''Return list of all sources of the header runs'''
+        return [row[0] for row in
+                self.conn.execute("SELECT DISTINCT source FROM header_run "
+                                  "ORDER BY source")]
+
+
+    def region_count(self):
+        '''Return count of rows in region table'''
+        return self.conn.execute("SELECT COUNT(*) FROM region").fetchone()[0]
+
+
+    def region_reset(self):
+        '''Delete all rows from region table'''
+        self.conn.execute("DELETE FROM region")
+
+
+    def region_insert(self, block_start, block_end, probes, hits,
+                      clock_start, clock_end):
+        '''Insert new row into region table'''
+        self.conn.execute(
+            "INSERT INTO region "
+            "VALUES (null, ?, ?, ?, ?, ?, ?, 0)",
+            (block_start, block_end, probes, hits, clock_start, clock_end))
+
+
+    def region_query(self):
+        '''Return iterator for all regions ordered by density of pack
+        headers, unscanned regions first'''
+        for result in self.conn.execute(
+            "SELECT id, block_start, block_end, probes, hits, clock_start, "
+                   "clock_end, done FROM region "
+            "ORDER BY done, 1.0 * hits / probes DESC, block_start"):
+            yield result
+
+
+    def region_set_done(self, region_id):
+        '''Mark region as completely scanned'''
+        self.conn.execute(
+            "UPDATE region "
+            "SET done = 1 "
+            "WHERE id = ?",
+            (region_id,))
+
+
+    def compressed_index_query(self, filename, file_size, mtime):
+        '''Return list of (position, offset, kind) tuples of the seek index
+        of a compressed file, empty if it has been changed since'''
+        return self.conn.execute(
+            "SELECT position, offset, kind FROM compressed_index "
+            "WHERE filename = ? AND file_size = ? AND mtime = ? "
+            "ORDER BY position",
+            (filename, file_size, mtime)).fetchall()
+
+
+    def compressed_index_save(self, filename, file_size, mtime, rows):
+        '''Replace seek index of a compressed file by rows of (position,
+        offset, kind) tuples'''
+        self.begin()
+        self.conn.execute(
+            "DELETE FROM compressed_index "
+            "WHERE filename = ?",
+            (filename,))
+        self.conn.executemany(
+            "INSERT INTO compressed_index "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [(filename, file_size, mtime) + tuple(row) for row in rows])
+        self.commit()
+
+
+    def state_key(self, key):
+        '''Return key of the state of the source'''
+        if self.source is None:
+            return key
+        return '%s:%s' % (self.source, key)
+
+
+    def state_reset(self):
+        '''Delete all entries of state table'''
+        self.conn.execute("DELETE FROM state")
+
+
+    def state_reset_source(self):
+        '''Delete all entries of the state of the source'''
+        if self.source is None:
+            self.conn.execute(
+                "DELETE FROM state "
+                "WHERE key NOT LIKE '%:%'")
+        else:
+            prefix = self.state_key('')
+            self.conn.execute(
+                "DELETE FROM state "
+                "WHERE substr(key, 1, ?) = ?",
+                (len(prefix), prefix))
+
+
+    def state_reset_export(self):
+        '''Delete the progress of an interrupted export'''
+        self.conn.execute(
+            "DELETE FROM state "
+            "WHERE key LIKE 'export\\_%' ESCAPE '\\'")
+
+
+    def state_query(self, key):
+        '''Return value of state of the source by key'''
+        result = self.conn.execute(
+            "SELECT value FROM state "
+            "WHERE key = ?",
+            (self.state_key(key),)).fetchone()
+        if result is None:
+            return None
+        return result[0]
+
+
+    def state_query_any(self, key):
+        '''Return True if the state of any source contains key'''
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM state "
+            "WHERE key = ? OR key LIKE ?",
+            (key, '%:' + key)).fetchone()[0] > 0
+
+
+    def state_delete(self, key):
+        '''Delete entry in state table of the source by key'''
+        self.conn.execute(
+            "DELETE from state "
+            "WHERE key = ?",
+            (self.state_key(key),))
+
+
+    def state_insert(self, key, value):
+        '''Insert key/value pair into state table of the source'''
+        self.conn.execute(
+            "INSERT INTO state "
+            "VALUES (?, ?)",
+            (self.state_key(key), value))
+
+
+    def setting_reset(self):
+        '''Delete all entries of setting table'''
+        self.conn.execute("DELETE FROM setting")
+
+
+    def setting_query(self, key):
+        '''Return value of setting by key'''
+        result = self.conn.execute(
+            "SELECT value FROM setting "
+            "WHERE key = ?",
+            (key,)).fetchone()
+        if result is None:
+            return None
+        return result[0]
+
+
+    def setting_delete(self, key):
+        '''Delete entry in setting table by key'''
+        self.conn.execute(
+            "DELETE from setting "
+            "WHERE key = ?",
+            (key,))
+
+
+    def setting_insert(self, key, value):
+        '''Insert key/value pair into setting table'''
+        self.conn.execute(
+            "INSERT INTO setting "
+            "VALUES (?, ?)",
+            (key, value))
+
+
+class ScanCache(object):
+    '''Results of finished scans shared by all databases
+
+    The results are stored by a key built from the fingerprint of the input
+    and all settings affecting the scan. Another database using the same
+    input (even under a different path) loads the chunks from the cache
+    instead of scanning the input again.'''
+    __slots__ = ('conn',)
+
+    columns = tuple([column for column in SqlManager.chunk_columns
+                     if column not in ('id', 'concat', 'duplicate',
+                                       'source', 'chain')])
+
+    def __init__(self):
+        self.conn = None
+
+
+    def open(self, filename):
+        '''Open (and create) cache database'''
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS scan("
+                "id INTEGER PRIMARY KEY,"
+                "key TEXT UNIQUE,"
+                "created REAL"
+            ")")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS scan_chunk("
+                "scan_id INTEGER"
+            ")")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS scan_chunk_scan_id "
+            "ON scan_chunk (scan_id)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS scan_run("
+                "scan_id INTEGER,"
+                "%s"
+            ")" % ', '.join(SqlManager.run_columns))
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS scan_run_scan_id "
+            "ON scan_run (scan_id)")
+        for table, columns in (('scan_chunk', self.columns),
+                               ('scan_run', SqlManager.run_columns)):
+            existing = [row[1] for row in
+                        self.conn.execute("PRAGMA table_info(%s)" % table)]
+            for column in columns:
+                if column not in existing:
+                    self.conn.execute("ALTER TABLE %s ADD COLUMN %s" %
+                                      (table, column))
+        self.conn.commit()
+
+
+    def close(self):
+        '''Close cache database'''
+        self.conn.close()
+
+
+    def load(self, key):
+        '''Return tuple of lists of chunks and header runs stored for key or
+        None'''
+        result = self.conn.execute(
+            "SELECT id FROM scan "
+            "WHERE key = ?",
+            (key,)).fetchone()
+        if result is None:
+            return None
+        chunks = []
+        for row in self.conn.execute(
+            "SELECT %s FROM scan_chunk "
+            "WHERE scan_id = ?" % ', '.join(self.columns),
+            (result[0],)):
+            chunk = Chunk()
+            for column, value in zip(self.columns, row):
+                setattr(chunk, column, value)
+            chunks.append(chunk)
+        runs = self.conn.execute(
+            "SELECT %s FROM scan_run "
+            "WHERE scan_id = ?" % ', '.join(SqlManager.run_columns),
+            (result[0],)).fetchall()
+        return (chunks, runs)
+
+
+    def store(self, key, chunks, runs):
+        '''Store list of chunks and header runs for key'''
+        for table in ('scan_chunk', 'scan_run'):
+            self.conn.execute(
+                "DELETE FROM %s "
+                "WHERE scan_id IN (SELECT id FROM scan WHERE key = ?)" %
+                table,
+                (key,))
+        self.conn.execute("DELETE FROM scan WHERE key = ?", (key,))
+        scan_id = self.conn.execute(
+            "INSERT INTO scan (key, created) "
+            "VALUES (?, ?)",
+            (key, time.time())).lastrowid
+        self.conn.executemany(
+            "INSERT INTO scan_chunk (scan_id, %s) "
+            "VALUES (?, %s)" % (', '.join(self.columns),
+                                ', '.join('?' * len(self.columns))),
+            [[scan_id] + [getattr(chunk, column) for column in self.columns]
+             for chunk in chunks])
+        self.conn.executemany(
+            "INSERT INTO scan_run (scan_id, %s) "
+            "VALUES (?, %s)" % (', '.join(SqlManager.run_columns),
+                                ', '.join('?' * len(SqlManager.run_columns))),
+            [[scan_id] + list(run) for run in runs])
+        self.conn.commit()
+
+
+
+class ChunkFactory(object):
+    '''Extract information of all chunks'''
+    __slots__ = ('current_block', 'clock', 'old_clock', 'timer', 'timer_all',
+                 'timer_blocks', 'blocksize', 'min_chunk_size', 'max_gap',
+                 'db_manager', 'reader', 'input_blocks', 'chunk',
+                 'skipped_blocks', 'follow_mapfile', 'follow_timeout',
+                 'header_run', 'stream_ids', 'headers', 'ts_layout',
+                 'detectors', 'pcr_pid')
 
     def __init__(self, main, reader):
         self.current_block = 0
         self.clock = 0
         self.old_clock = 0
         self.chunk = None
+        # [start, clock_start, max_delta, format, stream_ids, headers] of
+        # the current run of headers
+        self.header_run = None
+        # PES stream ids and count of headers with clock of the current chunk
+        self.stream_ids = set()
+        self.headers = 0
+        # (position, size) of the packets of the last transport stream block
+        self.ts_layout = None
+        self.pcr_pid = None
         self.timer = Timer()
         self.timer_all = Timer()
         self.timer_blocks = 0
+        self.skipped_blocks = 0
+        self.follow_mapfile = False
+        self.follow_timeout = None
 
         self.blocksize = main.blocksize
         self.min_chunk_size = main.min_chunk_size
         self.max_gap = main.max_create_gap
         self.db_manager = main.db_manager
 
+        detectors = {'ps': self.mpeg_header,
+                     'ts': self.ts_packets}
+        self.detectors = [(name, detectors[name])
+                          for name in main.formats.split(',')]
+
         self.reader = reader
         self.input_blocks = int(self.reader.get_size() / self.blocksize)
 
 
     def save_state(self):
+        self.db_manager.begin()
         if self.chunk is None:
             block_start = None
             clock_start = None
+            chunk_format = None
         else:
             block_start = self.chunk.block_start
             clock_start = self.chunk.clock_start
+            chunk_format = self.chunk.format
         self.db_manager.state_insert(
             'current_block',
             self.current_block)
@@ -687,31 +2522,99 @@ class ChunkFactory(object):
         self.db_manager.state_insert(
             'clock_start',
             clock_start)
+        self.db_manager.state_insert(
+            'chunk_format',
+            chunk_format)
+        self.save_stats_state()
         self.db_manager.state_insert(
             'old_clock',
             self.old_clock)
         self.db_manager.state_insert(
             'time_elapsed',
             self.timer_all.elapsed())
+        self.save_run_state()
         self.db_manager.commit()
 
 
+    def save_stats_state(self):
+        '''Save stream statistics of the current chunk to state table'''
+        self.db_manager.state_insert('stream_ids',
+                                     join_stream_ids(self.stream_ids))
+        self.db_manager.state_insert('headers', self.headers)
+
+
+    def load_stats_state(self):
+        '''Load stream statistics of the current chunk from state table'''
+        stream_ids = self.db_manager.state_query('stream_ids')
+        if stream_ids is not None:
+            self.stream_ids = split_stream_ids(stream_ids)
+            self.headers = self.db_manager.state_query('headers')
+
+
+    def save_run_state(self):
+        '''Save current run of headers to state table'''
+        if self.header_run is None:
+            header_run = (None, None, None, None, None, None)
+        else:
+            header_run = self.header_run[:4] + \
+                         [join_stream_ids(self.header_run[4]),
+                          self.header_run[5]]
+        for key, value in zip(('run_start', 'run_clock_start',
+                               'run_max_delta', 'run_format',
+                               'run_stream_ids', 'run_headers'),
+                              header_run):
+            self.db_manager.state_insert(key, value)
+
+
+    def load_run_state(self):
+        '''Load current run of headers from state table'''
+        header_run = [self.db_manager.state_query(key) for key in
+                      ('run_start', 'run_clock_start', 'run_max_delta',
+                       'run_format', 'run_stream_ids', 'run_headers')]
+        if header_run[0] is not None:
+            header_run[4] = split_stream_ids(header_run[4] or '')
+            header_run[5] = header_run[5] or 0
+            self.header_run = header_run
+
+
     def load_state(self):
         current_block = self.db_manager.state_query('current_block')
         block_start = self.db_manager.state_query('block_start')
         clock_start = self.db_manager.state_query('clock_start')
+        chunk_format = self.db_manager.state_query('chunk_format')
         old_clock = self.db_manager.state_query('old_clock')
         time_elapsed = self.db_manager.state_query('time_elapsed')
 
         self.current_block = current_block
-        if (block_start is not None) and (clock_start is not None):
+        if block_start is not None:
+            # chunks of transport streams may not have a clock yet
             self.chunk = Chunk()
             self.chunk.block_start = block_start
             self.chunk.clock_start = clock_start
+            self.chunk.format = chunk_format or 'ps'
+            self.load_stats_state()
         self.old_clock = old_clock
+        self.load_run_state()
         if time_elapsed is not None:
             self.timer_all.timecode -= time_elapsed
 
+        # A shared database commits every chunk immediately; forget the
+        # results found behind the saved state.
+        if self.current_block is None:
+            return
+        if self.chunk is not None:
+            self.db_manager.chunk_delete_from('block_start',
+                                              self.chunk.block_start)
+        else:
+            self.db_manager.chunk_delete_from('block_start',
+                                              self.current_block)
+        if self.header_run is not None:
+            self.db_manager.run_delete_from('block_start',
+                                            self.header_run[0])
+        else:
+            self.db_manager.run_delete_from('block_start',
+                                            self.current_block)
+
 
     def check_timer(self):
         '''Print statistics and save state if timer elapses'''
@@ -724,6 +2627,14 @@ class ChunkFactory(object):
             chunk_count = self.db_manager.chunk_count()
             speed = float(self.current_block - self.timer_blocks) \
                         / float(delta)
+            if not self.reader.complete():
+                # the size of compressed input is known at its end
+                print '%i blocks (%.1f bl/s; %.1f MiB/s): %i chunks' % \
+                      (self.current_block, speed,
+                       float(speed * self.blocksize) / float(1024**2),
+                       chunk_count)
+                self.timer_blocks = self.current_block
+                return
             print '[%5.1f%%] %i/%i blocks (%.1f bl/s; ' \
                   '%.1f MiB/s): %i chunks' % \
                   (
@@ -740,7 +2651,7 @@ class ChunkFactory(object):
 
     def finished(self):
         '''Print statistics and commit changes after finishing'''
-        self.db_manager.state_reset()
+        self.db_manager.state_reset_source()
         self.db_manager.commit()
 
         delta = self.timer_all.elapsed()
@@ -751,13 +2662,21 @@ class ChunkFactory(object):
         print 'Read %i of %i blocks.' % (self.current_block ,
                                          self.input_blocks)
         print 'Found %i chunks.' % chunk_count
+        wrapped = self.db_manager.chunk_count_wrapped()
+        if wrapped > 0:
+            print ('%i chunks continue across the wraparound of the clock '
+                   '(not split).') % wrapped
+        if self.skipped_blocks > 0:
+            print 'Skipped %i blocks without data.' % self.skipped_blocks
         print 'Took %.2f seconds.' % delta
         print 'Average speed was %.1f blocks/s (%.1f MiB/s).' % \
               (speed, float(speed * self.blocksize) / float(1024**2))
 
 
-    def mpeg_header(self, buf):
-        '''Check if buffer is mpeg header and return system clock or None'''
+    @staticmethod
+    def mpeg_header(buf, pos=0):
+        '''Check if buffer contains mpeg header at pos and return system clock
+        or None'''
         #            Partial Program Stream Pack header format
         #            =========================================
         #
@@ -781,73 +2700,307 @@ class ChunkFactory(object):
         # SCR -> 90 kHz Timer
         #
         # See http://en.wikipedia.org/wiki/MPEG_program_stream#Coding_structure
-        if ((ord(buf[0]) != 0x00) or
-            (ord(buf[1]) != 0x00) or
-            (ord(buf[2]) != 0x01) or
-            (ord(buf[3]) != 0xBA)):
+        if buf[pos:pos + 4] != PACK_START_CODE:
+            return None
+        if len(buf) < pos + 9:
             return None
 
-        marker_bit_1 = (ord(buf[4]) >> 6) & 3
-        marker_bit_2 = (ord(buf[4]) >> 2) & 1
-        marker_bit_3 = (ord(buf[6]) >> 2) & 1
-        marker_bit_4 = (ord(buf[8]) >> 2) & 1
+        byte_4 = ord(buf[pos + 4])
+        byte_6 = ord(buf[pos + 6])
+        byte_8 = ord(buf[pos + 8])
 
-        if ((marker_bit_1 != 1) or
-            (marker_bit_2 != 1) or
-            (marker_bit_3 != 1) or
-            (marker_bit_4 != 1)):
+        if (((byte_4 & 0xC4) != 0x44) or
+            ((byte_6 & 0x04) != 0x04) or
+            ((byte_8 & 0x04) != 0x04)):
             return None
 
-        clock_bits = [None] * 33
-
-        clock_bits[32] = (ord(buf[4]) >> 5) & 1;
-        clock_bits[31] = (ord(buf[4]) >> 4) & 1;
-        clock_bits[30] = (ord(buf[4]) >> 3) & 1;
-        clock_bits[29] = (ord(buf[4]) >> 1) & 1;
-        clock_bits[28] = (ord(buf[4]) >> 0) & 1;
-        clock_bits[27] = (ord(buf[5]) >> 7) & 1;
-        clock_bits[26] = (ord(buf[5]) >> 6) & 1;
-        clock_bits[25] = (ord(buf[5]) >> 5) & 1;
-        clock_bits[24] = (ord(buf[5]) >> 4) & 1;
-        clock_bits[23] = (ord(buf[5]) >> 3) & 1;
-        clock_bits[22] = (ord(buf[5]) >> 2) & 1;
-        clock_bits[21] = (ord(buf[5]) >> 1) & 1;
-        clock_bits[20] = (ord(buf[5]) >> 0) & 1;
-        clock_bits[19] = (ord(buf[6]) >> 7) & 1;
-        clock_bits[18] = (ord(buf[6]) >> 6) & 1;
-        clock_bits[17] = (ord(buf[6]) >> 5) & 1;
-        clock_bits[16] = (ord(buf[6]) >> 4) & 1;
-        clock_bits[15] = (ord(buf[6]) >> 3) & 1;
-        clock_bits[14] = (ord(buf[6]) >> 1) & 1;
-        clock_bits[13] = (ord(buf[6]) >> 0) & 1;
-        clock_bits[12] = (ord(buf[7]) >> 7) & 1;
-        clock_bits[11] = (ord(buf[7]) >> 6) & 1;
-        clock_bits[10] = (ord(buf[7]) >> 5) & 1;
-        clock_bits[ 9] = (ord(buf[7]) >> 4) & 1;
-        clock_bits[ 8] = (ord(buf[7]) >> 3) & 1;
-        clock_bits[ 7] = (ord(buf[7]) >> 2) & 1;
-        clock_bits[ 6] = (ord(buf[7]) >> 1) & 1;
-        clock_bits[ 5] = (ord(buf[7]) >> 0) & 1;
-        clock_bits[ 4] = (ord(buf[8]) >> 7) & 1;
-        clock_bits[ 3] = (ord(buf[8]) >> 6) & 1;
-        clock_bits[ 2] = (ord(buf[8]) >> 5) & 1;
-        clock_bits[ 1] = (ord(buf[8]) >> 4) & 1;
-        clock_bits[ 0] = (ord(buf[8]) >> 3) & 1;
-
-        clock = 0
-        for i in range(0,33):
-            clock += clock_bits[i] * 2**i
+        return (((byte_4 & 0x38) << 27) |
+                ((byte_4 & 0x03) << 28) |
+                (ord(buf[pos + 5]) << 20) |
+                ((byte_6 & 0xF8) << 12) |
+                ((byte_6 & 0x03) << 13) |
+                (ord(buf[pos + 7]) << 5) |
+                (byte_8 >> 3))
+
+
+    def ts_packets(self, buf):
+        '''Check if buffer contains transport stream packets and return
+        program clock reference, NO_CLOCK or None'''
+        #            Partial Transport Stream packet format
+        #            ======================================
+        #
+        # Byte  | Bits | Description
+        # ------|------|---------------------------------------------------
+        # 0     | 8    | sync byte 0x47
+        # 1..2  | 13   | packet identifier (PID, lower 13 bits)
+        # 3     | 2    | adaptation field control (0x20: field present)
+        # 4     | 8    | adaptation field length
+        # 5     | 8    | flags (0x10: PCR present)
+        # 6..11 | 48   | PCR: 33 bits base (90 kHz), 6 bits reserved,
+        #       |      | 9 bits extension (27 MHz)
+        #
+        # Packets are 188 bytes long, M2TS streams prefix every packet with
+        # a 4 bytes timestamp (192 bytes). The block is accepted if the sync
+        # byte is found at every packet start in the block. Only the 90 kHz
+        # base of the PCR is used, so clocks are comparable to the SCR.
+        #
+        # See http://en.wikipedia.org/wiki/MPEG_transport_stream
+        for size in TS_PACKET_SIZES:
+            pos = buf.find(TS_SYNC_BYTE, 0, size)
+            while pos != -1:
+                syncs = buf[pos::size]
+                if ((len(syncs) >= 4) and
+                    (syncs.count(TS_SYNC_BYTE) == len(syncs))):
+                    self.ts_layout = (pos, size)
+                    return self.ts_clock(buf, pos, size)
+                pos = buf.find(TS_SYNC_BYTE, pos + 1, size)
+        return None
+
+
+    def pes_stream_ids(self, buf, pos=0):
+        '''Return list of the stream ids of the PES packets following the
+        pack header at pos'''
+        # The pack header is 14 bytes long plus stuffing bytes (lower 3 bits
+        # of byte 13). It is followed by PES packets: start code 0x000001,
+        # stream id (0xBD/0xBF private, 0xC0-0xDF audio, 0xE0-0xEF video,
+        # 0xBA is the next pack), 16 bits length of the rest of the packet.
+        if len(buf) < pos + 14:
+            return []
+        pos += 14 + (ord(buf[pos + 13]) & 0x07)
+        stream_ids = []
+        while (pos + 6 <= len(buf)) and (buf[pos:pos + 3] == '\x00\x00\x01'):
+            stream_id = ord(buf[pos + 3])
+            if stream_id == 0xBA:
+                break
+            if (stream_id in (0xBD, 0xBF)) or (0xC0 <= stream_id <= 0xEF):
+                stream_ids.append(stream_id)
+            pos += 6 + ((ord(buf[pos + 4]) << 8) | ord(buf[pos + 5]))
+        return stream_ids
+
+
+    def ts_stream_ids(self, buf):
+        '''Return list of the stream ids of the PES packets starting in the
+        transport stream packets of the block detected last'''
+        # payload unit start indicator: bit 0x40 of byte 1; the payload
+        # follows the header (4 bytes) and the adaptation field
+        pos, size = self.ts_layout
+        stream_ids = []
+        for i in xrange(pos, len(buf) - 7, size):
+            if not (ord(buf[i + 1]) & 0x40):
+                continue
+            control = ord(buf[i + 3]) & 0x30
+            if not (control & 0x10):
+                continue
+            payload = i + 4
+            if control & 0x20:
+                payload += 1 + ord(buf[i + 4])
+            if ((payload + 4 <= min(len(buf), i + 188)) and
+                (buf[payload:payload + 3] == '\x00\x00\x01')):
+                stream_id = ord(buf[payload + 3])
+                if (stream_id in (0xBD, 0xBF)) or (0xC0 <= stream_id <= 0xEF):
+                    stream_ids.append(stream_id)
+        return stream_ids
+
+
+    def ts_clock(self, buf, pos, size):
+        '''Return first PCR of packets starting at pos or NO_CLOCK; PCRs of
+        the PID used last are preferred'''
+        clock = NO_CLOCK
+        pid = None
+        for i in xrange(pos, len(buf) - 11, size):
+            pcr = self.ts_pcr(buf, i)
+            if pcr is not None:
+                packet_pid = ((ord(buf[i + 1]) & 0x1F) << 8) | \
+                             ord(buf[i + 2])
+                if packet_pid == self.pcr_pid:
+                    return pcr
+                if clock == NO_CLOCK:
+                    clock = pcr
+                    pid = packet_pid
+        if pid is not None:
+            self.pcr_pid = pid
         return clock
 
 
+    @staticmethod
+    def ts_pcr(buf, pos):
+        '''Return PCR of the transport stream packet at pos or None'''
+        if ((ord(buf[pos + 3]) & 0x20) and
+            (ord(buf[pos + 4]) >= 7) and
+            (ord(buf[pos + 5]) & 0x10)):
+            return ((ord(buf[pos + 6]) << 25) |
+                    (ord(buf[pos + 7]) << 17) |
+                    (ord(buf[pos + 8]) << 9) |
+                    (ord(buf[pos + 9]) << 1) |
+                    (ord(buf[pos + 10]) >> 7))
+        return None
+
+
+    def detect(self, buf):
+        '''Return tuple (format, clock) of block or (None, None)'''
+        for name, detector in self.detectors:
+            clock = detector(buf)
+            if clock is not None:
+                return (name, clock)
+        return (None, None)
+
+
+    def data_blocks(self, first):
+        '''Return list of (start, end) tuples of block ranges containing
+        data, starting with block first'''
+        limit = self.input_blocks
+        if self.follow_mapfile:
+            pending = self.reader.rescue_map.pending_offset(
+                first * self.blocksize)
+            if pending is not None:
+                limit = min(limit, pending // self.blocksize)
+        ranges = []
+        for start, end in self.reader.get_data_extents():
+            start = max(start // self.blocksize, first)
+            end = min((end + self.blocksize - 1) // self.blocksize, limit)
+            if start >= end:
+                continue
+            if (len(ranges) > 0) and (ranges[-1][1] >= start):
+                ranges[-1] = (ranges[-1][0], max(ranges[-1][1], end))
+            else:
+                ranges.append((start, end))
+        return ranges
+
+
+    def position(self):
+        '''Return offset of the next byte to scan'''
+        return self.current_block * self.blocksize
+
+
+    def update_size(self):
+        '''Take over the size of the grown input'''
+        self.input_blocks = int(self.reader.get_size() / self.blocksize)
+
+
+    def wait_for_growth(self):
+        '''Wait until the input grows, return false if it didn't grow for
+        follow_timeout seconds and the end of the input has been scanned'''
+        if self.follow_timeout is None:
+            return False
+        self.save_state()
+        timer = Timer()
+        while timer.elapsed() < self.follow_timeout:
+            if self.reader.refresh():
+                self.update_size()
+                return True
+            time.sleep(FOLLOW_POLL_INTERVAL)
+        print 'Input hasn\'t grown for %i seconds.' % self.follow_timeout
+        # scan the rest up to the very end of the input once more
+        self.follow_timeout = None
+        return True
+
+
+    def wait_for_data(self):
+        '''Wait until ddrescue has read the data behind the current position
+        or the input has grown, return false if there is nothing to wait
+        for'''
+        if not self.reader.complete():
+            # the size of compressed input is known after decompressing it
+            self.reader.extend()
+            self.update_size()
+            return True
+        if not self.follow_mapfile:
+            return self.wait_for_growth()
+        rescue_map = self.reader.rescue_map
+        pending = rescue_map.pending_offset(self.position())
+        if (pending is None) or (pending >= self.reader.get_size()):
+            return False
+        self.save_state()
+        print 'Waiting for ddrescue to read offset %i...' % pending
+        time.sleep(MAPFILE_POLL_INTERVAL)
+        try:
+            rescue_map.load()
+        except RescueMapError:
+            # ddrescue is probably just writing the mapfile
+            pass
+        return True
+
+
+    def track_run(self, start, chunk_format, split=False):
+        '''Extend run of headers by header with self.clock found at start or
+        start a new run'''
+        if self.header_run is not None:
+            if split or (self.header_run[3] != chunk_format):
+                self.end_run()
+            elif ((self.clock != NO_CLOCK) and
+                  (self.header_run[1] is not None)):
+                delta = clock_delta(self.old_clock, self.clock)
+                if delta > RUN_SPLIT_GAP:
+                    self.end_run()
+                else:
+                    self.header_run[2] = max(self.header_run[2], delta)
+        if self.header_run is None:
+            self.header_run = [start, None, 0, chunk_format, set(), 0]
+        if (self.clock != NO_CLOCK) and (self.header_run[1] is None):
+            self.header_run[1] = self.clock
+
+
+    def run_clock_end(self):
+        '''Return last clock of the current run of headers'''
+        if self.header_run[1] is None:
+            return None
+        return self.old_clock
+
+
+    def end_run(self):
+        '''Save current run of headers to the header map'''
+        if self.header_run is not None:
+            (start, clock_start, max_delta, chunk_format, stream_ids,
+             headers) = self.header_run
+            self.db_manager.run_insert((start, self.current_block, None, None,
+                                        clock_start, self.run_clock_end(),
+                                        max_delta, chunk_format,
+                                        join_stream_ids(stream_ids), headers))
+            self.header_run = None
+
+
+    def skip(self, block):
+        '''Skip blocks without data up to block, they split the chunk'''
+        self.split()
+        self.end_run()
+        self.skipped_blocks += block - self.current_block
+        self.current_block = block
+
+
+    def start_chunk(self, chunk_format):
+        '''Start a new chunk at the current block'''
+        self.chunk = Chunk()
+        self.chunk.block_start = self.current_block
+        self.chunk.format = chunk_format
+        if self.clock != NO_CLOCK:
+            self.chunk.clock_start = self.clock
+        self.stream_ids = set()
+        self.headers = 0
+
+
+    def count_header(self, stream_ids):
+        '''Add header with clock (unless the block has no clock) and the PES
+        stream ids found behind it to the statistics of chunk and run'''
+        self.stream_ids.update(stream_ids)
+        self.header_run[4].update(stream_ids)
+        if self.clock != NO_CLOCK:
+            self.headers += 1
+            self.header_run[5] += 1
+
+
     def split(self):
         '''End current chunk and start a new one'''
         if self.chunk is not None:
             self.chunk.block_size = self.current_block - \
                                     self.chunk.block_start
             self.chunk.clock_end = self.old_clock
+            if self.chunk.clock_start is not None:
+                self.chunk.set_stats(self.stream_ids, self.headers,
+                                     self.blocksize)
 
-            if (self.chunk.block_size >= self.min_chunk_size):
+            # chunks without any clock can't be sorted, drop them
+            if ((self.chunk.block_size >= self.min_chunk_size) and
+                (self.chunk.clock_start is not None)):
                 self.db_manager.chunk_save(self.chunk)
             self.chunk = None
 
@@ -864,54 +3017,1207 @@ class ChunkFactory(object):
                                   'clear to clear database (you will '
                                   'lose all chunk information).')
             self.current_block = 0
-        self.db_manager.state_reset()
+        self.db_manager.state_reset_source()
         self.timer_blocks = self.current_block
+        while True:
+            for start, end in self.data_blocks(self.current_block):
+                if start != self.current_block:
+                    self.skip(start)
+                self.scan(end)
+            if not self.wait_for_data():
+                break
+        self.skip(self.input_blocks)
+        self.finished()
+
+
+    def scan(self, end):
+        '''Scan all blocks from current block up to block end'''
         self.reader.seek(self.current_block * self.blocksize)
-        for self.current_block in xrange(self.current_block,
-                                         self.input_blocks):
+        while self.current_block < end:
             self.check_timer()
             buf = self.reader.read(self.blocksize)
             if len(buf) != self.blocksize:
                 raise UnexpectedResultError('len(buf) != '
                                             'self.blocksize')
-            self.clock = self.mpeg_header(buf)
-            if self.clock is None:
+            chunk_format, self.clock = self.detect(buf)
+            if chunk_format is None:
                 self.split()
+                self.end_run()
             else:
+                if ((self.chunk is not None) and
+                    (self.chunk.format != chunk_format)):
+                    self.split()
+                self.track_run(self.current_block, chunk_format)
                 if self.chunk is None:
-                    self.chunk = Chunk()
-                    self.chunk.block_start = self.current_block
-                    self.chunk.clock_start = self.clock
+                    self.start_chunk(chunk_format)
+                elif self.clock != NO_CLOCK:
+                    if self.chunk.clock_start is None:
+                        self.chunk.clock_start = self.clock
+                    else:
+                        delta = clock_delta(self.old_clock, self.clock)
+                        if delta > self.max_gap:
+                            self.split()
+                            self.start_chunk(chunk_format)
+                if chunk_format == 'ps':
+                    self.count_header(self.pes_stream_ids(buf))
                 else:
-                    delta = self.clock - self.old_clock
-                    if (delta < 0) or (delta > self.max_gap):
-                        self.split()
-                        if self.chunk is None:
-                            self.chunk = Chunk()
-                            self.chunk.block_start = self.current_block
-                            self.chunk.clock_start = self.clock
-
-                self.old_clock = self.clock
-        self.current_block = self.current_block + 1
+                    self.count_header(self.ts_stream_ids(buf))
+
+                if self.clock != NO_CLOCK:
+                    self.old_clock = self.clock
+            self.current_block += 1
+
+
+
+class UnalignedChunkFactory(ChunkFactory):
+    '''Extract information of all chunks, packs may start at any offset'''
+    __slots__ = ('current_offset', 'last_offset', 'input_size')
+
+    def __init__(self, main, reader):
+        ChunkFactory.__init__(self, main, reader)
+        self.current_offset = 0
+        self.last_offset = None
+        self.input_size = self.reader.get_size()
+
+
+    def save_state(self):
+        self.db_manager.begin()
+        if self.chunk is None:
+            byte_start = None
+            clock_start = None
+        else:
+            byte_start = self.chunk.byte_start
+            clock_start = self.chunk.clock_start
+        self.db_manager.state_insert(
+            'current_offset',
+            self.current_offset)
+        self.db_manager.state_insert(
+            'last_offset',
+            self.last_offset)
+        self.db_manager.state_insert(
+            'byte_start',
+            byte_start)
+        self.db_manager.state_insert(
+            'clock_start',
+            clock_start)
+        self.save_stats_state()
+        self.db_manager.state_insert(
+            'old_clock',
+            self.old_clock)
+        self.db_manager.state_insert(
+            'time_elapsed',
+            self.timer_all.elapsed())
+        self.save_run_state()
+        self.db_manager.commit()
+
+
+    def load_state(self):
+        current_offset = self.db_manager.state_query('current_offset')
+        last_offset = self.db_manager.state_query('last_offset')
+        byte_start = self.db_manager.state_query('byte_start')
+        clock_start = self.db_manager.state_query('clock_start')
+        old_clock = self.db_manager.state_query('old_clock')
+        time_elapsed = self.db_manager.state_query('time_elapsed')
+
+        self.current_offset = current_offset
+        self.last_offset = last_offset
+        if (byte_start is not None) and (clock_start is not None):
+            self.new_chunk(byte_start, clock_start)
+            self.load_stats_state()
+        self.old_clock = old_clock
+        self.load_run_state()
+        if time_elapsed is not None:
+            self.timer_all.timecode -= time_elapsed
+
+        # see ChunkFactory.load_state
+        if self.current_offset is None:
+            return
+        if self.chunk is not None:
+            self.db_manager.chunk_delete_from('byte_start',
+                                              self.chunk.byte_start)
+        else:
+            self.db_manager.chunk_delete_from('byte_start',
+                                              self.current_offset)
+        if self.header_run is not None:
+            self.db_manager.run_delete_from('byte_start', self.header_run[0])
+        else:
+            self.db_manager.run_delete_from('byte_start',
+                                            self.current_offset)
+
+
+    def new_chunk(self, offset, clock):
+        '''Start a new chunk with the pack found at offset'''
+        self.chunk = Chunk()
+        self.chunk.byte_start = offset
+        self.chunk.block_start = offset // self.blocksize
+        self.chunk.clock_start = clock
+        self.chunk.format = 'ps'
+        self.stream_ids = set()
+        self.headers = 0
+
+
+    def split(self):
+        '''End current chunk and start a new one'''
+        if self.chunk is not None:
+            # The pack found last ends at the next pack header, but never
+            # spans more than one block.
+            end = min(self.last_offset + self.blocksize, self.current_offset)
+            self.chunk.byte_size = end - self.chunk.byte_start
+            self.chunk.block_size = self.chunk.byte_size // self.blocksize
+            self.chunk.clock_end = self.old_clock
+            self.chunk.set_stats(self.stream_ids, self.headers,
+                                 self.blocksize)
+
+            if (self.chunk.byte_size >= self.min_chunk_size * self.blocksize):
+                self.db_manager.chunk_save(self.chunk)
+            self.chunk = None
+
+
+    def end_run(self):
+        '''Save current run of headers to the header map'''
+        if self.header_run is not None:
+            (start, clock_start, max_delta, chunk_format, stream_ids,
+             headers) = self.header_run
+            end = min(self.last_offset + self.blocksize, self.current_offset)
+            self.db_manager.run_insert((start // self.blocksize,
+                                        end // self.blocksize, start, end,
+                                        clock_start, self.old_clock,
+                                        max_delta, chunk_format,
+                                        join_stream_ids(stream_ids),
+                                        headers))
+            self.header_run = None
+
+
+    def update_size(self):
+        ChunkFactory.update_size(self)
+        self.input_size = self.reader.get_size()
+
+
+    def data_extents(self, first):
+        '''Return list of (start, end) tuples of byte ranges containing data,
+        starting at offset first'''
+        limit = self.input_size
+        if (self.follow_timeout is not None) or not self.reader.complete():
+            # a pack header at the end might not be written (or decompressed)
+            # completely yet
+            limit = max(limit - 8, first)
+        if self.follow_mapfile:
+            pending = self.reader.rescue_map.pending_offset(first)
+            if pending is not None:
+                # a pack header in front of pending might reach into it
+                limit = min(limit, max(pending - 8, first))
+        extents = []
+        for start, end in self.reader.get_data_extents():
+            # a pack header at the end of the data might reach into the hole
+            end = min(end + 8, limit)
+            start = max(start, first)
+            if start >= end:
+                continue
+            if (len(extents) > 0) and (extents[-1][1] >= start):
+                extents[-1] = (extents[-1][0], max(extents[-1][1], end))
+            else:
+                extents.append((start, end))
+        return extents
+
+
+    def position(self):
+        '''Return offset of the next byte to scan'''
+        return self.current_offset
+
+
+    def pack(self, clock, stream_ids):
+        '''Process pack header found at current_offset followed by PES
+        packets of stream_ids'''
+        self.clock = clock
+        self.track_run(self.current_offset, 'ps',
+                       (self.header_run is not None) and
+                       (self.current_offset - self.last_offset >
+                        self.blocksize))
+        if self.chunk is not None:
+            distance = self.current_offset - self.last_offset
+            delta = clock_delta(self.old_clock, clock)
+            if (distance > self.blocksize) or (delta > self.max_gap):
+                self.split()
+        if self.chunk is None:
+            self.new_chunk(self.current_offset, clock)
+        self.count_header(stream_ids)
+        self.last_offset = self.current_offset
+        self.old_clock = clock
+
+
+    def run(self):
+        '''Main function for this class'''
+        self.load_state()
+        if self.current_offset is None:
+            if self.db_manager.chunk_count() != 0:
+                raise CreateError('No state information, but chunk '
+                                  'count is not 0. Probably the scan '
+                                  'finished already. Abort process to '
+                                  'avoid loss of data. Use parameter '
+                                  'clear to clear database (you will '
+                                  'lose all chunk information).')
+            self.current_offset = 0
+        self.db_manager.state_reset_source()
+        self.current_block = self.current_offset // self.blocksize
+        self.timer_blocks = self.current_block
+        while True:
+            for start, end in self.data_extents(self.current_offset):
+                # holes contain no pack headers, a pack behind a hole is too
+                # far away from the last one and splits the chunk
+                self.skipped_blocks += (start - self.current_offset) // \
+                                       self.blocksize
+                self.current_offset = start
+                self.scan(end)
+            if not self.wait_for_data():
+                break
+        self.skipped_blocks += (self.input_size - self.current_offset) // \
+                               self.blocksize
+        self.current_offset = self.input_size
+        self.current_block = self.input_blocks
         self.split()
+        self.end_run()
+        self.finished()
+
+
+    def scan(self, end):
+        '''Search pack headers from current offset up to offset end'''
+        offset = self.current_offset
+        self.reader.seek(offset)
+        tail = ''
+        while offset < end:
+            self.current_block = offset // self.blocksize
+            self.check_timer()
+            size = min(SCAN_BUFFER_SIZE, end - offset)
+            buf = tail + self.reader.read(size)
+            base = offset - len(tail)
+            offset += size
+            if offset < end:
+                # headers near the end are checked again with the next buffer
+                limit = len(buf) - 8
+            else:
+                limit = len(buf)
+            pos = buf.find(PACK_START_CODE)
+            while (pos != -1) and (pos < limit):
+                clock = self.mpeg_header(buf, pos)
+                if clock is not None:
+                    self.current_offset = base + pos
+                    self.pack(clock, self.pes_stream_ids(buf, pos))
+                pos = buf.find(PACK_START_CODE, pos + 1)
+            tail = buf[limit:]
+            self.current_offset = offset - len(tail)
+        self.current_offset = offset
+
+
+
+class SurveyChunkFactory(ChunkFactory):
+    '''Extract information of all chunks, most promising regions first
+
+    A sparse grid of blocks is probed first to find regions containing pack
+    headers. Every region starts and ends at a probed block without pack
+    header, so scanning the regions separately gives the same chunks as a
+    scan of the whole input. The regions are scanned in order of the
+    density of pack headers found by the probes.'''
+    __slots__ = ('step',)
+
+    def __init__(self, main, reader):
+        ChunkFactory.__init__(self, main, reader)
+        self.step = main.survey_step
+
+
+    def save_state(self):
+        # progress is saved per region
+        self.db_manager.commit()
+
+
+    def probe(self):
+        '''Probe grid of blocks and save regions containing pack headers'''
+        timer = Timer()
+        ranges = self.data_blocks(0)
+        hits = []
+        clocks = []
+        for block in xrange(0, self.input_blocks, self.step):
+            while (len(ranges) > 0) and (ranges[0][1] <= block):
+                del ranges[0]
+            chunk_format, clock = None, None
+            if (len(ranges) > 0) and (ranges[0][0] <= block):
+                self.reader.seek(block * self.blocksize)
+                chunk_format, clock = self.detect(
+                    self.reader.read(self.blocksize))
+            hits.append(chunk_format is not None)
+            if clock == NO_CLOCK:
+                clock = None
+            clocks.append(clock)
+
+        # an interrupted probe must not leave regions behind
+        self.db_manager.begin()
+        probe = 0
+        region_start = 0
+        while probe < len(hits):
+            if not hits[probe]:
+                probe += 1
+                continue
+            first = probe
+            while (probe < len(hits)) and hits[probe]:
+                probe += 1
+            # the region is surrounded by probes without pack headers
+            start = max(first - 1, 0) * self.step
+            end = min(probe * self.step, self.input_blocks)
+            if start > region_start:
+                self.db_manager.region_insert(region_start, start,
+                    (start - region_start + self.step - 1) // self.step,
+                    0, None, None)
+            self.db_manager.region_insert(start, end, probe - first + 2,
+                                          probe - first, clocks[first],
+                                          clocks[probe - 1])
+            region_start = end
+        if region_start < self.input_blocks:
+            self.db_manager.region_insert(region_start, self.input_blocks,
+                (self.input_blocks - region_start + self.step - 1) //
+                    self.step,
+                0, None, None)
+        self.db_manager.commit()
+        print 'Probed %i blocks in %.2f seconds.' % (len(hits),
+                                                    timer.elapsed())
+
+
+    def print_regions(self):
+        '''Print table of all regions'''
+        header_lines = ('-' * 5) + ('+' + ('-' * 14)) * 5
+        header_captions = (' ' * 5 + ('| %12s ' * 5)[:-1]) % ('Block Start',
+                                                              'Block End',
+                                                              'Density',
+                                                              'Clock Start',
+                                                              'Clock End')
+        print header_lines
+        print header_captions
+        print header_lines
+        fstr = '%4i ' + '| %12i ' * 2 + '| %11.1f%% ' + '| %12s ' * 2 + \
+               '%s'
+        index = 1
+        for (region_id, block_start, block_end, probes, hits, clock_start,
+             clock_end, done) in self.db_manager.region_query():
+            if hits == 0:
+                continue
+            if done:
+                status = ' (scanned)'
+            else:
+                status = ''
+            print fstr % (index, block_start, block_end,
+                          100.0 * hits / probes, clock_start, clock_end,
+                          status)
+            index += 1
+        print
+
+
+    def run(self):
+        '''Main function for this class'''
+        if ((self.db_manager.state_query('current_block') is not None) or
+            (self.db_manager.state_query('current_offset') is not None)):
+            raise CreateError('A scan started with parameter create is in '
+                              'progress. Finish it or use parameter clear '
+                              'to start over.')
+        if self.db_manager.region_count() == 0:
+            if self.db_manager.chunk_count() != 0:
+                raise CreateError('No survey information, but chunk '
+                                  'count is not 0. Probably a scan '
+                                  'finished already. Abort process to '
+                                  'avoid loss of data. Use parameter '
+                                  'clear to clear database (you will '
+                                  'lose all chunk information).')
+            self.probe()
+        self.print_regions()
+
+        regions = [region for region in self.db_manager.region_query()
+                   if not region[7]]
+        for index, region in enumerate(regions):
+            region_id, block_start, block_end = region[0:3]
+            # forget chunks of an interrupted scan of this region
+            self.db_manager.chunk_delete_range(block_start, block_end)
+            self.db_manager.run_delete_range(block_start, block_end)
+            self.chunk = None
+            self.header_run = None
+            self.current_block = block_start
+            self.timer_blocks = block_start
+            for start, end in self.data_blocks(block_start):
+                if start >= block_end:
+                    break
+                if start != self.current_block:
+                    self.skip(start)
+                self.scan(min(end, block_end))
+            self.skip(block_end)
+            self.db_manager.region_set_done(region_id)
+            self.db_manager.commit()
+            print 'Scanned region %i of %i (blocks %i-%i): %i chunks' % \
+                  (index + 1, len(regions), block_start, block_end,
+                   self.db_manager.chunk_count())
+        self.current_block = self.input_blocks
         self.finished()
 
 
 
+class OutputFile(object):
+    '''Preallocated output file with write-behind buffer
+
+    Writes to consecutive positions are collected in memory and passed to
+    the operating system in one call when the buffer is full or the next
+    write goes to another position.'''
+    __slots__ = ('filename', 'file', 'buffer', 'buffer_start')
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'r+b', 0)
+        self.buffer = bytearray()
+        self.buffer_start = 0
+
+
+    @staticmethod
+    def create(filename, size):
+        '''Create file with size bytes, reserve the blocks if possible'''
+        outf = open(filename, 'wb')
+        try:
+            if (posix_fallocate is not None) and (size > 0):
+                try:
+                    posix_fallocate(outf.fileno(), 0, size)
+                except OSError:
+                    # e.g. not supported by the file system
+                    pass
+            outf.truncate(size)
+        finally:
+            outf.close()
+
+
+    def buffered(self):
+        '''Return count of bytes waiting in the buffer'''
+        return len(self.buffer)
+
+
+    def write(self, position, data):
+        '''Write data at position of the file'''
+        if ((len(self.buffer) > 0) and
+            (self.buffer_start + len(self.buffer) != position)):
+            self.flush()
+        if (len(self.buffer) == 0) and (len(data) >= OUTPUT_BUFFER_SIZE):
+            self.file.seek(position)
+            self.file.write(data)
+            return
+        if len(self.buffer) == 0:
+            self.buffer_start = position
+        self.buffer.extend(data)
+        if len(self.buffer) >= OUTPUT_BUFFER_SIZE:
+            self.flush()
+
+
+    def flush(self):
+        '''Write buffered data to the file'''
+        if len(self.buffer) > 0:
+            self.file.seek(self.buffer_start)
+            self.file.write(self.buffer)
+            del self.buffer[:]
+
+
+    def sync(self):
+        '''Flush buffer and force data to disk'''
+        self.flush()
+        os.fsync(self.file.fileno())
+
+
+    def close(self):
+        '''Flush buffer and close file'''
+        self.flush()
+        self.file.close()
+
+
+
+class ExportPlanner(object):
+    '''Plan the export of several files with as few seeks as possible
+
+    All parts of all output files are collected first. Parts which are
+    physically contiguous are merged into single extents and the extents are
+    read in order of their disk offset. Every output file is preallocated and
+    the data is written to its position inside the file.
+
+    sync is one of EXPORT_SYNC_MODES: "file" forces every output file to
+    disk as soon as it is complete, "end" forces all files to disk after
+    the last one is written.
+
+    If db_manager is given, the progress is saved to the state table
+    regularly. As the extents are read in order, the progress is the
+    position in the sorted extents up to which all data has been written.
+    run(readers, True) continues an interrupted export of the same plan.'''
+    __slots__ = ('blocksize', 'sync', 'db_manager', 'files', 'pieces',
+                 'extents', 'handles', 'buffered', 'naive_seeks',
+                 'planned_seeks', 'skipped', 'bytes_written')
+
+    def __init__(self, blocksize, sync='none', db_manager=None):
+        self.blocksize = blocksize
+        self.sync = sync
+        self.db_manager = db_manager
+        self.skipped = 0
+        # data written by run, without the files and parts written by the
+        # interrupted export
+        self.bytes_written = 0
+        self.files = []
+        self.pieces = []
+        self.extents = []
+        self.handles = {}
+        self.buffered = 0
+        self.naive_seeks = 0
+        self.planned_seeks = 0
+
+
+    def add_file(self, filename, chunks, source=None):
+        '''Add output file consisting of chunks (in chain order) of source'''
+        index = len(self.files)
+        dst = 0
+        last = None
+        for chunk in chunks:
+            src, size = chunk.extent(self.blocksize)
+            # exporting part by part needs one seek for every part
+            self.naive_seeks += 1
+            if (last is not None) and (last[1] + last[2] == src):
+                last[2] += size
+            else:
+                last = [source, src, size, index, dst]
+                self.pieces.append(last)
+            dst += size
+        self.files.append({'filename': filename,
+                           'size': dst,
+                           'remaining': dst,
+                           'parts': len(chunks)})
+
+
+    def plan(self):
+        '''Merge contiguous pieces into extents and sort them by offset'''
+        self.pieces.sort()
+        self.extents = []
+        for piece in self.pieces:
+            if ((len(self.extents) > 0) and
+                (self.extents[-1]['source'] == piece[0]) and
+                (self.extents[-1]['end'] == piece[1])):
+                extent = self.extents[-1]
+                extent['end'] += piece[2]
+                extent['pieces'].append(piece)
+            else:
+                self.extents.append({'source': piece[0],
+                                     'start': piece[1],
+                                     'end': piece[1] + piece[2],
+                                     'pieces': [piece]})
+        self.planned_seeks = len(self.extents)
+
+
+    def output(self, index):
+        '''Return opened output file by index'''
+        if index not in self.handles:
+            if len(self.handles) >= MAX_OPEN_OUTPUT_FILES:
+                self.close()
+            self.handles[index] = OutputFile(self.files[index]['filename'])
+        return self.handles[index]
+
+
+    def write(self, index, position, data):
+        '''Write data at position of output file by index'''
+        outf = self.output(index)
+        before = outf.buffered()
+        outf.write(position, data)
+        self.bytes_written += len(data)
+        self.buffered += outf.buffered() - before
+        if self.buffered > MAX_OUTPUT_BUFFERED:
+            for outf in self.handles.itervalues():
+                outf.flush()
+            self.buffered = 0
+
+        item = self.files[index]
+        item['remaining'] -= len(data)
+        if item['remaining'] == 0:
+            # file is complete, don't keep its buffer and handle
+            outf = self.handles.pop(index)
+            self.buffered -= outf.buffered()
+            if self.sync == 'file':
+                outf.sync()
+            outf.close()
+
+
+    def close(self):
+        '''Close all opened output files'''
+        for outf in self.handles.itervalues():
+            outf.close()
+        self.handles = {}
+        self.buffered = 0
+
+
+    def preallocate(self, indexes):
+        '''Create output files by index with their final size'''
+        for index in indexes:
+            item = self.files[index]
+            OutputFile.create(item['filename'], item['size'])
+
+
+    def sync_all(self):
+        '''Force all output files to disk'''
+        for item in self.files:
+            outf = OutputFile(item['filename'])
+            outf.sync()
+            outf.close()
+
+
+    def sources(self):
+        '''Return list of the sources of all output files'''
+        return list(set([piece[0] for piece in self.pieces]))
+
+
+    def plan_key(self):
+        '''Return hash identifying output files and pieces of the plan'''
+        key = hashlib.sha1()
+        key.update(repr([(item['filename'], item['size'])
+                         for item in self.files]))
+        key.update(repr(sorted(self.pieces)))
+        return key.hexdigest()
+
+
+    def written(self, position):
+        '''Return list of the segments (source, src, dst, size) of every
+        output file written before position (source, offset) in the sorted
+        pieces'''
+        result = [[] for item in self.files]
+        for source, src, size, index, dst in self.pieces:
+            if (source, src + size) <= position:
+                result[index].append((source, src, dst, size))
+            elif (source == position[0]) and (src < position[1]):
+                result[index].append((source, src, dst, position[1] - src))
+        return result
+
+
+    def save_state(self, position):
+        '''Save position up to which all data is written to state table'''
+        if self.db_manager is None:
+            return
+        for outf in self.handles.itervalues():
+            outf.flush()
+        written = self.written(position)
+        self.db_manager.begin()
+        self.db_manager.state_reset_export()
+        self.db_manager.state_insert('export_plan', self.plan_key())
+        self.db_manager.state_insert('export_source', position[0])
+        self.db_manager.state_insert('export_offset', position[1])
+        for index, item in enumerate(self.files):
+            if item['remaining'] == 0:
+                count = item['size']
+            else:
+                count = sum([segment[3] for segment in written[index]])
+            self.db_manager.state_insert('export_file_%i' % index, count)
+        self.db_manager.commit()
+
+
+    def verify(self, index, segments, readers):
+        '''Return True if sampled blocks of the segments of output file by
+        index match the input'''
+        item = self.files[index]
+        if not os.path.isfile(item['filename']):
+            return False
+        if os.path.getsize(item['filename']) != item['size']:
+            return False
+        total = sum([segment[3] for segment in segments])
+        blocks = total // self.blocksize
+        if blocks == 0:
+            return True
+        outf = open(item['filename'], 'rb')
+        try:
+            for i in xrange(FINGERPRINT_SAMPLES):
+                position = ((blocks - 1) * i //
+                            max(FINGERPRINT_SAMPLES - 1, 1) * self.blocksize)
+                for source, src, dst, size in segments:
+                    if position < size:
+                        break
+                    position -= size
+                length = min(self.blocksize, size - position)
+                reader = readers[source]
+                reader.seek(src + position)
+                outf.seek(dst + position)
+                if reader.read(length) != outf.read(length):
+                    return False
+        finally:
+            outf.close()
+        return True
+
+
+    def resume_complete(self, readers):
+        '''Drop pieces of the output files which exist and match the input,
+        return indexes of the other output files'''
+        segments = [[] for item in self.files]
+        for source, src, size, index, dst in self.pieces:
+            segments[index].append((source, src, dst, size))
+        create = []
+        for index, item in enumerate(self.files):
+            if self.verify(index, segments[index], readers):
+                print 'Skipping file %s (complete).' % item['filename']
+                item['remaining'] = 0
+                self.skipped += 1
+            else:
+                create.append(index)
+        keep = set(range(len(self.files))) - set(create)
+        self.pieces = [piece for piece in self.pieces
+                       if piece[3] not in keep]
+        self.naive_seeks = sum([self.files[index]['parts']
+                                for index in create])
+        return create
+
+
+    def resume(self, readers):
+        '''Drop pieces written by the interrupted export, return indexes of
+        the output files which must be created'''
+        if self.db_manager.state_query('export_offset') is None:
+            # the export finished or failed before the first checkpoint
+            print 'No interrupted export found, checking the output files.'
+            return self.resume_complete(readers)
+        if self.db_manager.state_query('export_plan') != self.plan_key():
+            raise ExportError('The recordings to export have changed since '
+                              'the export was interrupted. Run export '
+                              'without --resume.')
+        position = (self.db_manager.state_query('export_source'),
+                    self.db_manager.state_query('export_offset'))
+        written = self.written(position)
+        create = []
+        keep = set()
+        for index, item in enumerate(self.files):
+            count = sum([segment[3] for segment in written[index]])
+            if count == 0:
+                create.append(index)
+            elif not self.verify(index, written[index], readers):
+                print 'File %s differs, exporting it again.' % \
+                      item['filename']
+                create.append(index)
+            else:
+                keep.add(index)
+                item['remaining'] -= count
+                if item['remaining'] == 0:
+                    print 'Skipping file %s (complete).' % item['filename']
+                    self.skipped += 1
+                else:
+                    print 'Resuming file %s at %i of %i bytes.' % \
+                          (item['filename'], count, item['size'])
+
+        pieces = []
+        # seeks of an export part by part without the written parts
+        self.naive_seeks = sum([item['parts']
+                                for index, item in enumerate(self.files)
+                                if index not in keep])
+        for piece in self.pieces:
+            source, src, size, index, dst = piece
+            if index not in keep:
+                pieces.append(piece)
+            elif (source, src + size) <= position:
+                continue
+            elif (source == position[0]) and (src < position[1]):
+                done = position[1] - src
+                pieces.append([source, src + done, size - done, index,
+                               dst + done])
+                self.naive_seeks += 1
+            else:
+                pieces.append(piece)
+                self.naive_seeks += 1
+        self.pieces = pieces
+        return create
+
+
+    def run(self, readers, resume=False):
+        '''Read all extents and write the data to the output files; readers
+        maps every source to its FileReader'''
+        if resume:
+            create = self.resume(readers)
+        else:
+            create = range(len(self.files))
+        self.plan()
+        self.preallocate(create)
+        position = None
+        checkpoint = 0
+        try:
+            for extent in self.extents:
+                reader = readers[extent['source']]
+                reader.seek(extent['start'])
+                offset = extent['start']
+                while offset < extent['end']:
+                    length = min(EXPORT_BUFFER_SIZE, extent['end'] - offset)
+                    buf = reader.read(length)
+                    if len(buf) != length:
+                        raise UnexpectedResultError('len(buf) != length')
+                    for source, src, size, index, dst in extent['pieces']:
+                        start = max(src, offset)
+                        end = min(src + size, offset + length)
+                        if start >= end:
+                            continue
+                        self.write(index, dst + start - src,
+                                   buf[start - offset:end - offset])
+                    offset += length
+                    position = (extent['source'], offset)
+                    checkpoint += length
+                    if checkpoint >= EXPORT_CHECKPOINT_INTERVAL:
+                        self.save_state(position)
+                        checkpoint = 0
+        except (KeyboardInterrupt, EnvironmentError, DvrRecoverError):
+            # e.g. a failing output or input: keep the progress for
+            # export --resume, but don't hide the error by a second one
+            error = sys.exc_info()
+            if position is not None:
+                try:
+                    self.save_state(position)
+                except (EnvironmentError, sqlite3.Error), e:
+                    print 'Warning: Saving the progress failed: %s' % e
+            raise error[0], error[1], error[2]
+        self.close()
+        if self.sync == 'end':
+            self.sync_all()
+        if self.db_manager is not None:
+            self.db_manager.state_reset_export()
+            self.db_manager.commit()
+
+
+
+class RecordingStream(object):
+    '''Seekable read-only file object for the concatenated chunks of a
+    recording
+
+    The stream is built from the first chunk of a chain and reads the data
+    directly from the input files. Several streams may share one FileReader;
+    pass a lock if they are used by different threads.'''
+    __slots__ = ('name', 'parts', 'size', 'starts', 'extents', 'reader',
+                 'lock', 'position', 'closed')
+
+    def __init__(self, db_manager, chunk, reader, blocksize, name=None,
+                 lock=None):
+        chunks = db_manager.chunk_query_chain(chunk)
+        self.name = name
+        self.parts = len(chunks)
+        self.size = 0
+        # starts[i] is the logical offset of extents[i] in the recording
+        self.starts = []
+        self.extents = []
+        for chunk in chunks:
+            offset, size = chunk.extent(blocksize)
+            self.starts.append(self.size)
+            self.extents.append((offset, size))
+            self.size += size
+        self.reader = reader
+        self.lock = lock
+        self.position = 0
+        self.closed = False
+
+
+    def map(self, offset, size):
+        '''Return list of (input offset, size) tuples covering size bytes of
+        the recording starting at offset'''
+        result = []
+        index = bisect.bisect_right(self.starts, offset) - 1
+        while (size > 0) and (index < len(self.extents)):
+            delta = offset - self.starts[index]
+            length = min(size, self.extents[index][1] - delta)
+            result.append((self.extents[index][0] + delta, length))
+            offset += length
+            size -= length
+            index += 1
+        return result
+
+
+    def readinto_at(self, offset, view):
+        '''Read data at offset of the recording into writable buffer without
+        changing the position of the stream, return count of bytes'''
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        count = 0
+        for input_offset, size in self.map(offset, len(view)):
+            if self.lock is not None:
+                self.lock.acquire()
+            try:
+                self.reader.seek(input_offset)
+                count += self.reader.readinto(view[count:count + size])
+            finally:
+                if self.lock is not None:
+                    self.lock.release()
+        return count
+
+
+    def read_at(self, offset, size):
+        '''Read data at offset of the recording without changing the position
+        of the stream'''
+        size = max(min(size, self.size - offset), 0)
+        buf = bytearray(size)
+        count = self.readinto_at(offset, memoryview(buf))
+        return str(buf[:count])
+
+
+    def fingerprint(self, blocksize):
+        '''Return hash of the size and sampled blocks of the recording'''
+        fingerprint = hashlib.sha1()
+        fingerprint.update('%i\0' % self.size)
+        blocks = self.size // blocksize
+        if blocks > 0:
+            for i in xrange(FINGERPRINT_SAMPLES):
+                block = (blocks - 1) * i // max(FINGERPRINT_SAMPLES - 1, 1)
+                fingerprint.update(self.read_at(block * blocksize, blocksize))
+        return fingerprint.hexdigest()
+
+
+    def clocks_at(self, offset, size, chunk_format):
+        '''Return list of (offset, clock) tuples of the pack headers (program
+        stream) or PCRs (transport stream) in size bytes at offset'''
+        return [(offset + pos, clock) for pos, clock in
+                find_clocks(self.read_at(offset, size), chunk_format)]
+
+
+    def locate_clock(self, clock, clock_start, chunk_format):
+        '''Return offset of the pack header or PCR with clock or None; the
+        clock of the recording grows from clock_start'''
+        target = clock_delta(clock_start, clock)
+        # the pack header searched lies in [low, high)
+        low = 0
+        high = self.size
+        while high - low > 2 * DEDUP_WINDOW:
+            middle = (low + high) // 2
+            clocks = self.clocks_at(middle, DEDUP_WINDOW, chunk_format)
+            if len(clocks) == 0:
+                return None
+            offset, found = clocks[0]
+            if clock_delta(clock_start, found) < target:
+                low = middle
+            else:
+                high = offset + 1
+        for offset, found in self.clocks_at(low, high - low + DEDUP_WINDOW,
+                                            chunk_format):
+            if found == clock:
+                return offset
+        return None
+
+
+    def readinto(self, view):
+        '''Read data into writable buffer, return count of bytes'''
+        if not isinstance(view, memoryview):
+            view = memoryview(view)
+        size = max(min(len(view), self.size - self.position), 0)
+        count = self.readinto_at(self.position, view[:size])
+        self.position += count
+        return count
+
+
+    def read(self, size=-1):
+        '''Read at most size bytes, all remaining bytes if size is negative'''
+        if (size < 0) or (self.position + size > self.size):
+            size = self.size - self.position
+        buf = self.read_at(self.position, size)
+        self.position += len(buf)
+        return buf
+
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        '''Set position of the stream'''
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        elif whence != os.SEEK_SET:
+            raise ValueError('Invalid whence: %r' % whence)
+        if offset < 0:
+            raise ValueError('Negative seek position %i' % offset)
+        self.position = offset
+        return self.position
+
+
+    def tell(self):
+        '''Return position of the stream'''
+        return self.position
+
+
+    def readable(self):
+        return True
+
+
+    def seekable(self):
+        return True
+
+
+    def writable(self):
+        return False
+
+
+    def close(self):
+        '''Close stream (the shared FileReader stays open)'''
+        self.closed = True
+
+
+
+class RecordingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''HTTP server streaming recordings directly from the input file'''
+    daemon_threads = True
+
+    def __init__(self, address, recordings):
+        BaseHTTPServer.HTTPServer.__init__(self, address,
+                                           RecordingRequestHandler)
+        self.recordings = recordings
+
+
+
+class RecordingRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Serve list of recordings and recordings with support for ranges'''
+
+    def do_HEAD(self):
+        self.handle_request(False)
+
+
+    def do_GET(self):
+        self.handle_request(True)
+
+
+    def handle_request(self, send_body):
+        '''Dispatch request to list or recording'''
+        path = self.path.split('?', 1)[0]
+        if path == '/':
+            self.send_list(send_body)
+            return
+        for recording in self.server.recordings:
+            if path == '/' + recording.name:
+                self.send_recording(recording, send_body)
+                return
+        self.send_error(404)
+
+
+    def send_list(self, send_body):
+        '''Send HTML page with links to all recordings'''
+        lines = ['<html><head><title>dvr-recover</title></head><body>',
+                 '<h1>Recordings</h1>', '<ul>']
+        for recording in self.server.recordings:
+            lines.append('<li><a href="/%s">%s</a> (%i parts, %.1f MiB)'
+                         '</li>' % (cgi.escape(recording.name, True),
+                                    cgi.escape(recording.name),
+                                    recording.parts,
+                                    float(recording.size) / float(1024**2)))
+        lines.extend(['</ul>', '</body></html>'])
+        body = '\n'.join(lines)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+
+    def parse_range(self, size):
+        '''Return (start, end) of requested range, None for the whole file
+        or False for an unsatisfiable range'''
+        header = self.headers.getheader('Range')
+        if header is None:
+            return None
+        match = re.match(r'^bytes=(\d*)-(\d*)$', header.strip())
+        if match is None:
+            # multiple or unknown ranges, send whole file
+            return None
+        start, end = match.groups()
+        if start == '':
+            if end == '':
+                return None
+            start = max(size - int(end), 0)
+            end = size - 1
+        else:
+            start = int(start)
+            if end == '':
+                end = size - 1
+            else:
+                end = min(int(end), size - 1)
+        if (start >= size) or (start > end):
+            return False
+        return (start, end)
+
+
+    def send_recording(self, recording, send_body):
+        '''Send (range of) recording'''
+        byte_range = self.parse_range(recording.size)
+        if byte_range is False:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%i' % recording.size)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if byte_range is None:
+            start, end = 0, recording.size - 1
+            self.send_response(200)
+        else:
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %i-%i/%i' %
+                             (start, end, recording.size))
+        if recording.name.endswith('.ts'):
+            self.send_header('Content-Type', 'video/mp2t')
+        else:
+            self.send_header('Content-Type', 'video/mpeg')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if not send_body:
+            return
+        try:
+            offset = start
+            while offset <= end:
+                length = min(end - offset + 1, SERVE_BUFFER_SIZE)
+                self.wfile.write(recording.read_at(offset, length))
+                offset += length
+        except socket.error:
+            # client closed connection (e.g. the player seeked)
+            pass
+
+
+
+class PrefixWriter(object):
+    '''Output stream writing prefix in front of every line'''
+    __slots__ = ('stream', 'prefix', 'line_start', 'softspace')
+
+    def __init__(self, stream, prefix):
+        self.stream = stream
+        self.prefix = prefix
+        self.line_start = True
+        self.softspace = 0
+
+
+    def write(self, data):
+        for line in data.splitlines(True):
+            if self.line_start:
+                self.stream.write(self.prefix)
+            self.stream.write(line)
+            self.line_start = line.endswith('\n')
+            if self.line_start:
+                self.stream.flush()
+
+
+    def flush(self):
+        self.stream.flush()
+
+
+
 class Main(object):
     '''Main class for this application'''
     __slots__ = ('input_filenames', 'db_filename', 'export_dir', 'blocksize',
                  'min_chunk_size', 'max_create_gap', 'max_sort_gap',
-                 'db_manager')
+                 'scan_mode', 'formats', 'mapfile', 'survey_step',
+                 'follow_timeout', 'io_rate', 'io_priority', 'rate_limiter',
+                 'cache_file', 'export_sync', 'export_duplicates',
+                 'sources', 'db_manager')
 
     def __init__(self):
         self.input_filenames = None
+        self.sources = None
         self.db_filename = 'dvr-recover.sqlite'
         self.export_dir = None
         self.blocksize = None
         self.min_chunk_size = None
         self.max_create_gap = None
         self.max_sort_gap = None
+        self.scan_mode = None
+        self.formats = None
+        self.export_sync = None
+        self.export_duplicates = None
+        self.mapfile = None
+        self.survey_step = None
+        self.follow_timeout = None
+        self.io_rate = None
+        self.io_priority = None
+        self.rate_limiter = None
+        self.cache_file = None
 
         self.db_manager = SqlManager()
 
@@ -924,11 +4230,28 @@ class Main(object):
         self.min_chunk_size = self.db_manager.setting_query('min_chunk_size')
         self.max_create_gap = self.db_manager.setting_query('max_create_gap')
         self.max_sort_gap = self.db_manager.setting_query('max_sort_gap')
+        self.scan_mode = self.db_manager.setting_query('scan_mode')
+        self.formats = self.db_manager.setting_query('formats')
+        self.export_sync = self.db_manager.setting_query('export_sync')
+        self.export_duplicates = self.db_manager.setting_query(
+            'export_duplicates')
+        self.mapfile = self.db_manager.setting_query('mapfile')
+        self.survey_step = self.db_manager.setting_query('survey_step')
+        self.follow_timeout = self.db_manager.setting_query('follow_timeout')
+        self.io_rate = self.db_manager.setting_query('io_rate')
+        self.io_priority = self.db_manager.setting_query('io_priority')
+        self.cache_file = self.db_manager.setting_query('cache_file')
 
         if self.input_filenames is not None:
             self.input_filenames = str(self.input_filenames).split('\0')
         else:
             self.input_filenames = []
+        self.sources = {}
+        names = self.db_manager.setting_query('sources')
+        if names is not None:
+            for name in str(names).split('\0'):
+                self.sources[name] = str(self.db_manager.setting_query(
+                    'source %s' % name)).split('\0')
         if self.blocksize is None:
             self.blocksize = 2048
         if self.min_chunk_size is None:
@@ -937,6 +4260,24 @@ class Main(object):
             self.max_create_gap = 90000 # 1 second
         if self.max_sort_gap is None:
             self.max_sort_gap = 90000 # 1 second
+        if self.scan_mode is None:
+            self.scan_mode = 'aligned'
+        if self.formats is None:
+            self.formats = 'ps,ts'
+        if self.export_sync is None:
+            self.export_sync = 'end'
+        if self.export_duplicates is None:
+            self.export_duplicates = 'copy'
+        if self.survey_step is None:
+            self.survey_step = 32768 # 64 MiB
+        if self.follow_timeout is None:
+            self.follow_timeout = 60
+        if self.io_rate is None:
+            self.io_rate = 0
+        if self.io_priority is None:
+            self.io_priority = 'none'
+        if self.cache_file is None:
+            self.cache_file = os.path.expanduser('~/.dvr-recover-cache.sqlite')
 
 
     def usage(self):
@@ -950,8 +4291,10 @@ class Main(object):
         if len(args) == 0:
             args.append('show')
 
-        if (args[0] == 'input') and (len(args) > 1):
+        if (args[0] in ('input', 'source')) and (len(args) > 1):
             args[0:2] = (args[0] + ' '+ args[1],)
+        if args == ['mapfile', 'clear']:
+            args = ['mapfile clear']
 
         parameters = {
                 'show': 0,
@@ -959,11 +4302,25 @@ class Main(object):
                 'input add': 1,
                 'input del': 1,
                 'input clear': 0,
+                'source add': 2,
+                'source del': 2,
+                'source clear': 1,
                 'blocksize': 1,
                 'min_chunk_size': 1,
                 'max_create_gap': 1,
                 'max_sort_gap': 1,
+                'survey_step': 1,
+                'follow_timeout': 1,
+                'io_rate': 1,
+                'io_priority': 1,
                 'export_dir': 1,
+                'scan_mode': 1,
+                'formats': 1,
+                'export_sync': 1,
+                'export_duplicates': 1,
+                'cache_file': 1,
+                'mapfile': 1,
+                'mapfile clear': 0,
             }
 
         if args[0] not in parameters:
@@ -976,9 +4333,44 @@ class Main(object):
             return
 
         if args[0] in ('blocksize', 'min_chunk_size', 'max_create_gap',
-                       'max_sort_gap'):
+                       'max_sort_gap', 'survey_step', 'follow_timeout'):
             self.db_manager.setting_insert(args[0], int(args[1]))
-        elif args[0] in ('export_dir'):
+        elif args[0] in ('export_dir', 'mapfile', 'cache_file'):
+            self.db_manager.setting_insert(args[0], args[1])
+        elif args[0] == 'mapfile clear':
+            self.db_manager.setting_insert('mapfile', None)
+        elif args[0] == 'scan_mode':
+            if args[1] not in SCAN_MODES:
+                print 'Invalid scan mode: %s' % args[1]
+                return
+            self.db_manager.setting_insert(args[0], args[1])
+        elif args[0] == 'formats':
+            for name in args[1].split(','):
+                if name not in FORMATS:
+                    print 'Invalid format: %s' % name
+                    return
+            self.db_manager.setting_insert(args[0], args[1])
+        elif args[0] == 'export_sync':
+            if args[1] not in EXPORT_SYNC_MODES:
+                print 'Invalid sync mode: %s' % args[1]
+                return
+            self.db_manager.setting_insert(args[0], args[1])
+        elif args[0] == 'io_rate':
+            self.db_manager.setting_insert(args[0], float(args[1]))
+        elif args[0] == 'io_priority':
+            try:
+                parse_io_priority(args[1])
+            except ValueError:
+                print 'Invalid I/O priority: %s' % args[1]
+                return
+            self.db_manager.setting_insert(args[0], args[1])
+        elif args[0] == 'export_duplicates':
+            if args[1] not in EXPORT_DUPLICATES_MODES:
+                print 'Invalid duplicates mode: %s' % args[1]
+                return
+            if (args[1] == 'link') and not hasattr(os, 'link'):
+                print 'Hard links are not supported on this system.'
+                return
             self.db_manager.setting_insert(args[0], args[1])
         elif args[0] in 'input clear':
             self.db_manager.setting_insert('input_filenames', None)
@@ -992,24 +4384,303 @@ class Main(object):
             else:
                 binary = None
             self.db_manager.setting_insert('input_filenames', binary)
+        elif args[0] in ('source add', 'source del', 'source clear'):
+            name = args[1]
+            if ((SOURCE_NAME.match(name) is None) or
+                (name == DEFAULT_SOURCE_LABEL)):
+                print 'Invalid source name: %s' % name
+                return
+            filenames = self.sources.get(name, [])
+            if args[0] == 'source add':
+                filenames.append(args[2])
+            elif args[0] == 'source del':
+                filenames.remove(args[2])
+            else:
+                filenames = []
+            if len(filenames) > 0:
+                self.sources[name] = filenames
+                self.db_manager.setting_insert('source %s' % name,
+                                               buffer('\0'.join(filenames)))
+            else:
+                self.sources.pop(name, None)
+                self.db_manager.setting_delete('source %s' % name)
+            if len(self.sources) > 0:
+                binary = buffer('\0'.join(sorted(self.sources)))
+            else:
+                binary = None
+            self.db_manager.setting_insert('sources', binary)
         elif args[0] == 'show':
             for filename in self.input_filenames:
                 print 'input_file:', filename
             if len(self.input_filenames) == 0:
                 print 'No input files specified!'
+            for name in sorted(self.sources):
+                for filename in self.sources[name]:
+                    print 'source %s:' % name, filename
             print 'export_dir:', self.export_dir
             print 'blocksize:', self.blocksize
             print 'min_chunk_size:', self.min_chunk_size
             print 'max_create_gap:', self.max_create_gap
             print 'max_sort_gap:', self.max_sort_gap
+            print 'survey_step:', self.survey_step
+            print 'follow_timeout:', self.follow_timeout
+            print 'io_rate:', self.io_rate
+            print 'io_priority:', self.io_priority
+            print 'scan_mode:', self.scan_mode
+            print 'formats:', self.formats
+            print 'export_sync:', self.export_sync
+            print 'export_duplicates:', self.export_duplicates
+            print 'mapfile:', self.mapfile
+            print 'cache_file:', self.cache_file
         elif args[0] == 'reset':
             self.db_manager.setting_reset()
 
 
     def create(self):
         '''Find all chunks in input file and write them to chunk file'''
-        reader = FileReader(self.input_filenames)
-        cf = ChunkFactory(self, reader)
+        follow = None
+        for arg in sys.argv[2:]:
+            if arg not in ('--follow', '--follow-mapfile'):
+                raise CreateError('Unknown argument: %s' % arg)
+            if (follow is not None) and (follow != arg[2:]):
+                raise CreateError('Use either --follow or --follow-mapfile.')
+            follow = arg[2:]
+        if len(self.sources) == 0:
+            self.scan(None, follow)
+            return
+
+        # scan all sources at the same time, every source is read by one
+        # process only; io_rate limits the sum of their rates
+        names = sorted(self.sources)
+        if len(self.input_filenames) > 0:
+            names.insert(0, None)
+        bucket = RateLimiter.create_bucket()
+        started = time.time()
+        workers = []
+        for name in names:
+            worker = multiprocessing.Process(target=scan_source,
+                                             args=(self.db_filename, name,
+                                                   follow, bucket, started))
+            worker.start()
+            workers.append((name, worker))
+        failed = []
+        for name, worker in workers:
+            worker.join()
+            if worker.exitcode != 0:
+                failed.append(self.source_label(name))
+        if len(failed) > 0:
+            raise CreateError('Scan of %s failed.' % ', '.join(failed))
+        print
+        print 'Scanned %i sources.' % len(names)
+
+
+    def scan(self, source, follow):
+        '''Find all chunks in the input files of source; follow is None,
+        "follow" (wait for the input to grow) or "follow-mapfile"'''
+        # the mapfile belongs to the input files
+        follow_mapfile = (follow == 'follow-mapfile') and (source is None)
+        reader = self.open_reader(self.source_filenames(source))
+        if (self.mapfile is not None) and (source is None):
+            reader.rescue_map = RescueMap(self.mapfile)
+        elif follow_mapfile:
+            raise CreateError('No mapfile specified!')
+        if ((follow == 'follow') and
+            (reader.parts[-1]['stream'] is not None)):
+            raise CreateError('A compressed input can\'t be followed.')
+        cache = None
+        if ((self.cache_file != 'none') and
+            not follow_mapfile and (follow != 'follow')):
+            cache = ScanCache()
+            cache.open(self.cache_file)
+            key = self.scan_cache_key(reader)
+            if ((self.db_manager.state_query('current_block') is None) and
+                (self.db_manager.state_query('current_offset') is None) and
+                (self.db_manager.chunk_count() == 0)):
+                result = cache.load(key)
+                if result is not None:
+                    chunks, runs = result
+                    for chunk in chunks:
+                        self.db_manager.chunk_save(chunk)
+                    for run in runs:
+                        self.db_manager.run_insert(run)
+                    print 'Loaded %i chunks of a previous scan of the same ' \
+                          'input from %s.' % (len(chunks), self.cache_file)
+                    cache.close()
+                    reader.close()
+                    return
+        if self.scan_mode == 'unaligned':
+            cf = UnalignedChunkFactory(self, reader)
+        else:
+            cf = ChunkFactory(self, reader)
+        cf.follow_mapfile = follow_mapfile
+        if follow == 'follow':
+            cf.follow_timeout = self.follow_timeout
+        cf.run()
+        if cache is not None:
+            cache.store(key, [chunk for chunk in self.db_manager.chunk_query()
+                              if chunk.source == source],
+                        list(self.db_manager.run_query()))
+            cache.close()
+        reader.close()
+
+
+    def source_label(self, source):
+        '''Return name of source for messages'''
+        if source is None:
+            return DEFAULT_SOURCE_LABEL
+        return source
+
+
+    def source_filenames(self, source):
+        '''Return list of input files of source'''
+        if source is None:
+            return self.input_filenames
+        if source not in self.sources:
+            raise FileReaderError('Unknown source: %s' % source)
+        return self.sources[source]
+
+
+    def open_reader(self, filenames):
+        '''Return FileReader of filenames, all readers share the limits of
+        io_rate and io_priority'''
+        if self.rate_limiter is None:
+            self.rate_limiter = RateLimiter(self.io_rate, self.io_priority)
+        reader = FileReader(filenames, self.db_manager)
+        reader.limiter = self.rate_limiter
+        return reader
+
+
+    def open_readers(self, sources):
+        '''Return dict of FileReader objects of all sources'''
+        readers = {}
+        for source in sources:
+            readers[source] = self.open_reader(self.source_filenames(source))
+        return readers
+
+
+    def scan_cache_key(self, reader):
+        '''Return key of the scan results in the cache'''
+        key = hashlib.sha1()
+        key.update('%i\0%s\0' % (SCAN_CACHE_VERSION,
+                                  reader.get_fingerprint(self.blocksize)))
+        key.update('%i\0%i\0%i\0%s\0' % (self.blocksize,
+                                          self.min_chunk_size,
+                                          self.max_create_gap,
+                                          self.scan_mode))
+        if self.scan_mode == 'aligned':
+            key.update('%s\0' % self.formats)
+        if reader.rescue_map is not None:
+            # only the rescued regions are scanned
+            key.update(repr(reader.get_data_extents()))
+        return key.hexdigest()
+
+
+    def rechunk(self):
+        '''Rebuild chunks from the header map of the last scan'''
+        if (self.db_manager.state_query_any('current_block') or
+            self.db_manager.state_query_any('current_offset')):
+            raise CreateError('The scan is not finished yet.')
+        if self.db_manager.run_count() == 0:
+            raise CreateError('No header map found. Run the scan again '
+                              '(parameters clear and create).')
+        self.db_manager.chunk_reset()
+        inexact = 0
+        wrapped = 0
+
+        def save(chunk, stream_ids, headers):
+            if (chunk is None) or (chunk.clock_start is None):
+                return
+            if chunk.byte_start is None:
+                size = chunk.block_size
+            else:
+                size = chunk.byte_size // self.blocksize
+            if size >= self.min_chunk_size:
+                # runs of older versions have no statistics
+                if stream_ids is not None:
+                    chunk.set_stats(stream_ids, headers, self.blocksize)
+                self.db_manager.chunk_save(chunk)
+
+        for source in self.db_manager.run_query_sources():
+            self.db_manager.source = source
+            chunk = None
+            last = None
+            stream_ids = None
+            headers = 0
+            for run in self.db_manager.run_query():
+                (block_start, block_end, byte_start, byte_end, clock_start,
+                 clock_end, max_delta, chunk_format, run_stream_ids,
+                 run_headers) = run
+                if max_delta > self.max_create_gap:
+                    # a full scan would split this run
+                    inexact += 1
+                if (last is None) or (last[7] != chunk_format):
+                    adjacent = False
+                elif byte_start is None:
+                    adjacent = (last[1] == block_start)
+                else:
+                    adjacent = (last[3] == byte_start)
+                if adjacent and (clock_start is not None) and \
+                   (chunk.clock_end is not None):
+                    adjacent = (clock_delta(chunk.clock_end, clock_start) <=
+                                self.max_create_gap)
+                if adjacent:
+                    if chunk.clock_start is None:
+                        chunk.clock_start = clock_start
+                    if clock_end is not None:
+                        chunk.clock_end = clock_end
+                    if byte_start is None:
+                        chunk.block_size = block_end - chunk.block_start
+                    else:
+                        chunk.byte_size = byte_end - chunk.byte_start
+                        chunk.block_size = chunk.byte_size // self.blocksize
+                else:
+                    save(chunk, stream_ids, headers)
+                    stream_ids = set()
+                    headers = 0
+                    chunk = Chunk()
+                    chunk.block_start = block_start
+                    chunk.block_size = block_end - block_start
+                    chunk.clock_start = clock_start
+                    chunk.clock_end = clock_end
+                    chunk.format = chunk_format
+                    if byte_start is not None:
+                        chunk.byte_start = byte_start
+                        chunk.byte_size = byte_end - byte_start
+                        chunk.block_size = chunk.byte_size // self.blocksize
+                if (stream_ids is not None) and (run_stream_ids is not None):
+                    stream_ids.update(split_stream_ids(run_stream_ids))
+                    headers += run_headers
+                else:
+                    stream_ids = None
+                last = run
+            save(chunk, stream_ids, headers)
+            wrapped += self.db_manager.chunk_count_wrapped()
+        self.db_manager.source = None
+        print 'Found %i chunks.' % len(list(self.db_manager.chunk_query_ids()))
+        if wrapped > 0:
+            print ('%i chunks continue across the wraparound of the clock '
+                   '(not split).') % wrapped
+        if inexact > 0:
+            print ('Warning: %i runs of headers contain steps of the clock '
+                   'larger than max_create_gap. Run a full scan for exact '
+                   'results.') % inexact
+
+
+    def survey(self):
+        '''Probe input file for regions with chunks and scan them first'''
+        if self.scan_mode != 'aligned':
+            raise CreateError('Parameter survey supports only the aligned '
+                              'scan mode.')
+        reader = self.open_reader(self.input_filenames)
+        if self.mapfile is not None:
+            reader.rescue_map = RescueMap(self.mapfile)
+        if not reader.complete():
+            # the probes are spread over the whole input
+            print 'Decompressing input to determine its size...'
+            reader.build_index()
+        # sort, show and export may be called while the survey is running
+        self.db_manager.share(None)
+        cf = SurveyChunkFactory(self, reader)
         cf.run()
         reader.close()
 
@@ -1022,12 +4693,16 @@ class Main(object):
             for chunk1 in self.db_manager.chunk_query():
                 if chunk1.id == chunk2.id:
                     continue
+                if ((chunk1.format != chunk2.format) or
+                    (chunk1.source != chunk2.source)):
+                    continue
                 new_target = True
-                delta = chunk2.clock_start - chunk1.clock_end
-                if (delta < 0) or (delta > self.max_sort_gap):
+                delta = clock_delta(chunk1.clock_end, chunk2.clock_start)
+                if delta > self.max_sort_gap:
                     continue
                 if target is not None:
-                    if delta >= chunk2.clock_start - target.clock_end:
+                    if delta >= clock_delta(target.clock_end,
+                                            chunk2.clock_start):
                         new_target = False
                 if new_target:
                     target = chunk1
@@ -1035,108 +4710,481 @@ class Main(object):
                 chunk2.concat = target.id
                 self.db_manager.chunk_save(chunk2)
         self.db_manager.chunk_fix_multiple_concats();
+        self.db_manager.chunk_update_chains()
+        # the recordings have changed, duplicates must be searched again
+        self.db_manager.chunk_reset_duplicate()
+        wrapped = self.db_manager.chunk_count_wrapped_concats()
+        if wrapped > 0:
+            print ('Concatenated %i chunks across the wraparound of the '
+                   'clock.') % wrapped
 
 
     def reset(self):
         '''Sort chunks by block_start and clear concat attribute'''
         self.db_manager.chunk_reset_concat()
+        self.db_manager.chunk_reset_duplicate()
+
+
+    def dedup(self):
+        '''Mark recordings which are stored more than once'''
+        self.db_manager.chunk_reset_duplicate()
+        readers = self.open_readers(self.db_manager.chunk_query_sources())
+
+        # cheap comparison first: format, clock range and size of the chains
+        groups = {}
+        numbers = {}
+        recordings = []
+        index = 1
+        for chunk in self.db_manager.chunk_query():
+            if chunk.concat is not None:
+                continue
+            stream = RecordingStream(self.db_manager, chunk,
+                                     readers[chunk.source], self.blocksize)
+            chain = self.db_manager.chunk_query_chain(chunk)
+            span = clock_delta(chunk.clock_start, chain[-1].clock_end)
+            key = (chunk.format, chunk.clock_start, chain[-1].clock_end,
+                   stream.size)
+            groups.setdefault(key, []).append((chunk, stream))
+            recordings.append((chunk, span, stream))
+            numbers[chunk.id] = index
+            index += 1
+
+        def mark(chunk, original):
+            chunk.duplicate = original.id
+            self.db_manager.chunk_save(chunk)
+            print 'File #%i is a duplicate of file #%i.' % \
+                  (numbers[chunk.id], numbers[original.id])
+
+        # exact copies: compare sampled blocks of the candidates
+        duplicates = 0
+        for candidates in groups.itervalues():
+            if len(candidates) < 2:
+                continue
+            fingerprints = {}
+            for chunk, stream in candidates:
+                fingerprint = stream.fingerprint(self.blocksize)
+                fingerprints.setdefault(fingerprint, []).append(chunk)
+            for chunks in fingerprints.itervalues():
+                # keep the copy located first on the disk
+                chunks.sort(key=lambda x: (x.source,
+                                           x.extent(self.blocksize)[0]))
+                for chunk in chunks[1:]:
+                    mark(chunk, chunks[0])
+                    duplicates += 1
+
+        # trimmed or edited copies: the clock range lies within the one of a
+        # longer recording which contains the sampled blocks at the same
+        # clock; the longest copy is kept
+        chunks = dict([(x[0].id, x[0]) for x in recordings])
+        recordings.sort(key=lambda x: (-x[1], x[0].source,
+                                       x[0].extent(self.blocksize)[0]))
+        for i in xrange(len(recordings)):
+            chunk, span, stream = recordings[i]
+            if chunk.duplicate is not None:
+                continue
+            for original, original_span, original_stream in recordings[:i]:
+                if original.format != chunk.format:
+                    continue
+                start = clock_delta(original.clock_start, chunk.clock_start)
+                if start >= CLOCK_MODULUS - DEDUP_CLOCK_TOLERANCE:
+                    # starts a bit in front of the original
+                    start -= CLOCK_MODULUS
+                if start + span > original_span + DEDUP_CLOCK_TOLERANCE:
+                    continue
+                if not self.contains_copy(original_stream,
+                                          original.clock_start, stream,
+                                          chunk.format):
+                    continue
+                while original.duplicate is not None:
+                    original = chunks[original.duplicate]
+                mark(chunk, original)
+                duplicates += 1
+                break
+
+        # copies of a recording found to be a trimmed copy itself
+        for chunk in chunks.itervalues():
+            if chunk.duplicate is None:
+                continue
+            original = chunks[chunk.duplicate]
+            if original.duplicate is None:
+                continue
+            while original.duplicate is not None:
+                original = chunks[original.duplicate]
+            chunk.duplicate = original.id
+            self.db_manager.chunk_save(chunk)
+
+        for reader in readers.itervalues():
+            reader.close()
+        self.db_manager.commit()
+        print 'Found %i duplicates.' % duplicates
+
+
+    def contains_copy(self, original, clock_start, copy, chunk_format):
+        '''Return True if sampled blocks of the recording copy are found at
+        the same clock in the recording original starting at clock_start'''
+        blocks = copy.size // self.blocksize
+        matches = 0
+        for i in xrange(DEDUP_SAMPLES):
+            if matches + DEDUP_SAMPLES - i < DEDUP_MIN_MATCHES:
+                return False
+            block = max(blocks - 1, 0) * i // max(DEDUP_SAMPLES - 1, 1)
+            clocks = copy.clocks_at(block * self.blocksize, DEDUP_WINDOW,
+                                    chunk_format)
+            if len(clocks) == 0:
+                continue
+            offset, clock = clocks[0]
+            position = original.locate_clock(clock, clock_start,
+                                             chunk_format)
+            if position is None:
+                continue
+            data = copy.read_at(offset, self.blocksize)
+            if original.read_at(position, len(data)) == data:
+                matches += 1
+        return matches >= DEDUP_MIN_MATCHES
 
 
     def clear(self):
         '''Delete all chunks'''
         self.db_manager.chunk_reset()
         self.db_manager.state_reset()
+        self.db_manager.region_reset()
+        self.db_manager.run_reset()
 
 
     def show(self):
         '''Dump chunk list file in a human readable way'''
-        header_lines = ('-' * 5) + ('+' + ('-' * 14)) * 5
-        header_captions = (' ' * 5 + ('| %12s ' * 5)[:-1]) % ('Block Start',
-                                                              'Block Size',
-                                                              'Clock Start',
-                                                              'Clock End',
-                                                              'Concatenate')
+        filters, order, limit, offset, json_output = self.show_arguments()
+        self.db_manager.snapshot()
+
+        # numbers of the recordings as used by export
+        numbers = {}
+        index = 1
+        for chunk_id in self.db_manager.chunk_query_heads():
+            numbers[chunk_id] = index
+            index += 1
+
+        rescue_map = None
+        if self.mapfile is not None:
+            rescue_map = RescueMap(self.mapfile)
+
+        if json_output:
+            for chain in self.db_manager.chain_query(filters, order, limit,
+                                                     offset):
+                print json.dumps(self.chain_dict(chain, numbers, rescue_map),
+                                 sort_keys=True)
+            return
+
+        captions = ['Chunk Id', 'Block Start', 'Block Size', 'Clock Start',
+                    'Clock End', 'Concatenate']
+        show_format = (self.db_manager.chunk_query_formats() not in
+                       ([], ['ps']))
+        if show_format:
+            captions.append('Format')
+        show_source = (self.db_manager.chunk_query_sources() not in
+                       ([], [None]))
+        if show_source:
+            captions.append('Source')
+        show_duplicate = (self.db_manager.chunk_count_duplicates() > 0)
+        if show_duplicate:
+            captions.append('Duplicate of')
+        if rescue_map is not None:
+            captions.append('Damaged')
+        header_lines = ('-' * 5) + ('+' + ('-' * 14)) * len(captions)
+        header_captions = (' ' * 5 + ('| %12s ' * len(captions))[:-1]) % \
+                          tuple(captions)
         print header_lines
         print header_captions
         print header_lines
 
-        fstr        = ' ' + '| %12i ' * 4 + '| %10s'
+        fstr        = ' ' + '| %12i ' * 5 + '| %10s'
+        if show_format:
+            fstr += '   | %12s'
+        if show_source:
+            fstr += '   | %12s'
+        if show_duplicate:
+            fstr += '   | %12s'
+        if rescue_map is not None:
+            fstr += '   | %10s'
         fstr_main   = '%4i' + fstr
         fstr_concat = '%4s' + fstr
 
-        chunk_tuple = lambda x, y: (y,
-                                    x.block_start,
-                                    x.block_size,
-                                    x.clock_start,
-                                    x.clock_end,
-                                    x.concat is not None)
-        index = 1
-        for chunk in self.db_manager.chunk_query():
-            if chunk.concat is not None:
+        def chunk_tuple(x, y):
+            result = (y,
+                      x.id,
+                      x.block_start,
+                      x.block_size,
+                      x.clock_start,
+                      x.clock_end,
+                      x.concat is not None)
+            if show_format:
+                result += (x.format,)
+            if show_source:
+                result += (self.source_label(x.source),)
+            if show_duplicate:
+                if x.duplicate is None:
+                    result += ('',)
+                else:
+                    result += (numbers[x.duplicate],)
+            if rescue_map is not None:
+                offset, size = x.extent(self.blocksize)
+                result += (rescue_map.is_damaged(offset, offset + size),)
+            return result
+
+        count = 0
+        for chain in self.db_manager.chain_query(filters, order, limit,
+                                                 offset):
+            chunk = self.db_manager.chunk_load(chain[0])
+            print fstr_main % chunk_tuple(chunk, numbers[chunk.id])
+            for chunk2 in self.db_manager.chunk_query_chain(chunk)[1:]:
+                print fstr_concat % chunk_tuple(chunk2, '#')
+            count += 1
+
+        if (len(filters) > 0) or (limit >= 0) or (offset > 0):
+            print
+            print 'Showing %i of %i matching recordings.' % \
+                  (count, self.db_manager.chain_count(filters))
+
+
+    def show_arguments(self):
+        '''Parse arguments of parameter show, return tuple (filters, order,
+        limit, offset, json_output)'''
+        filters = {}
+        order = 'number'
+        limit = -1
+        offset = 0
+        json_output = False
+        args = sys.argv[2:]
+        while len(args) > 0:
+            arg = args.pop(0)
+            if arg == '--json':
+                json_output = True
                 continue
-            print fstr_main % chunk_tuple(chunk, index)
+            if arg not in SHOW_OPTIONS:
+                raise ShowError('Unknown argument: %s' % arg)
+            if len(args) == 0:
+                raise ShowError('Argument %s expects a value.' % arg)
+            value = args.pop(0)
+            try:
+                if arg == '--sort':
+                    if value not in SqlManager.chain_orders:
+                        raise ShowError('Invalid sort order: %s' % value)
+                    order = value
+                elif arg == '--limit':
+                    limit = int(value)
+                elif arg == '--offset':
+                    offset = int(value)
+                elif arg in ('--clock', '--blocks'):
+                    # range START:END, both sides are optional
+                    start, end = value.split(':')
+                    prefix = {'--clock': 'clock', '--blocks': 'block'}[arg]
+                    if start != '':
+                        filters[prefix + '_min'] = int(start)
+                    if (end != '') and (arg == '--clock'):
+                        # a chain continuing across the wraparound of the
+                        # clock may end behind START
+                        filters['clock_max'] = (int(end),
+                                                filters.get('clock_min', 0))
+                    elif end != '':
+                        filters[prefix + '_max'] = int(end)
+                elif arg == '--stream':
+                    # PES stream id in hex, e.g. e0
+                    stream_id = int(value, 16)
+                    if not (0 <= stream_id <= 0xFF):
+                        raise ValueError
+                    filters['stream'] = '%02x' % stream_id
+                else:
+                    filters[arg[2:].replace('-', '_')] = int(value)
+            except ValueError:
+                raise ShowError('Invalid value of %s: %s' % (arg, value))
+        return (filters, order, limit, offset, json_output)
+
+
+    def chain_dict(self, chain, numbers, rescue_map):
+        '''Return dict describing a recording for the JSON output of show'''
+        chunk_id, parts, size, clock_start, clock_end, block_start, \
+            block_end = chain
+        chunks = self.db_manager.chunk_query_chain(
+            self.db_manager.chunk_load(chunk_id))
+        duplicate = chunks[0].duplicate
+        if duplicate is not None:
+            duplicate = numbers[duplicate]
+        result = {'id': chunk_id,
+                  'number': numbers[chunk_id],
+                  'parts': parts,
+                  'size': size,
+                  'clock_start': clock_start,
+                  'clock_end': clock_end,
+                  'block_start': block_start,
+                  'block_end': block_end,
+                  'format': chunks[0].format,
+                  'source': self.source_label(chunks[0].source),
+                  'duplicate_of': duplicate,
+                  'stream_ids': None,
+                  'chunks': []}
+        for chunk in chunks:
+            offset, length = chunk.extent(self.blocksize)
+            item = {'id': chunk.id,
+                    'block_start': chunk.block_start,
+                    'block_size': chunk.block_size,
+                    'byte_start': offset,
+                    'byte_size': length,
+                    'clock_start': chunk.clock_start,
+                    'clock_end': chunk.clock_end,
+                    'byte_rate': chunk.byte_rate,
+                    'stream_ids': chunk.stream_ids,
+                    'clockless_blocks': chunk.clockless_blocks}
+            if rescue_map is not None:
+                item['damaged'] = rescue_map.is_damaged(offset,
+                                                        offset + length)
+            result['chunks'].append(item)
+        # union of the stream ids of all parts, if they are known
+        stream_ids = set()
+        for chunk in chunks:
+            if chunk.stream_ids is None:
+                break
+            stream_ids.update(split_stream_ids(chunk.stream_ids))
+        else:
+            result['stream_ids'] = join_stream_ids(stream_ids)
+        return result
 
-            def process_concats(chunk):
-                chunk2 = self.db_manager.chunk_query_concat(chunk)
-                if chunk2 is not None:
-                    print fstr_concat % chunk_tuple(chunk2, '#')
-                    process_concats(chunk2)
 
-            process_concats(chunk)
-            index += 1
+    def recording_filename(self, chunk, index):
+        '''Return file name of the recording starting with chunk'''
+        if chunk.format == 'ts':
+            return 'file_%04i.ts' % index
+        return 'file_%04i.mpg' % index
 
 
     def export(self):
         '''export single chunk or all chunks'''
-        def export_chunk(reader, outf, chunk, part):
-            '''Write chunk and concats to output file'''
-            timer = Timer()
-            reader.seek(chunk.block_start * self.blocksize)
-            for i in xrange(0, chunk.block_size):
-                buf = reader.read(self.blocksize)
-                if len(buf) != self.blocksize:
-                    raise UnexpectedResultError('len(buf) != self.blocksize')
-                outf.write(buf)
-            delta = timer.elapsed()
-            speed = float(chunk.block_size) / float(delta)
-            print 'Part #%i: %.2fs (%.2f blocks/s; %.2f MiB/s).' % \
-                  (part,
-                   delta,
-                   speed,
-                   float(speed * self.blocksize) / float(1024**2))
-            chunk2 = self.db_manager.chunk_query_concat(chunk)
-            if chunk2 is not None:
-                export_chunk(reader, outf, chunk2, part+1)
+        planner = ExportPlanner(self.blocksize, self.export_sync,
+                                self.db_manager)
+        resume = ('--resume' in sys.argv[2:])
+        if resume:
+            sys.argv.remove('--resume')
+        links = []
 
         def export_file(chunk, index):
-            '''Open output file and write chunks'''
-            print 'Exporting file #%i' % index
-            reader = FileReader(self.input_filenames)
-            outf = open(os.path.join(self.export_dir, 'file_%04i.mpg' % index),
-                        'wb')
-            export_chunk(reader, outf, chunk, 1)
-            outf.close()
+            '''Add output file and its chunks to export plan'''
+            chain = self.db_manager.chunk_query_chain(chunk)
+            filename = os.path.join(self.export_dir,
+                                    self.recording_filename(chunk, index))
+            planner.add_file(filename, chain, chunk.source)
+            print 'Exporting file #%i (%i parts)' % (index, len(chain))
+            return filename
+
+        selected = self.export_selection()
+        index = 1
+        filenames = {}
+        duplicates = []
+        for chunk_id in self.db_manager.chunk_query_heads():
+            if (selected is None) or (chunk_id in selected):
+                chunk = self.db_manager.chunk_load(chunk_id)
+                if ((chunk.duplicate is not None) and
+                    (self.export_duplicates != 'copy')):
+                    duplicates.append((chunk, index))
+                else:
+                    filenames[chunk.id] = export_file(chunk, index)
+            index += 1
+        for chunk, index in duplicates:
+            if self.export_duplicates == 'skip':
+                print 'Skipping file #%i (duplicate)' % index
+            elif chunk.duplicate not in filenames:
+                # original is not part of this export
+                export_file(chunk, index)
+            else:
+                filename = os.path.join(
+                    self.export_dir, self.recording_filename(chunk, index))
+                links.append((filenames[chunk.duplicate], filename))
+                print 'Linking file #%i (duplicate)' % index
+
+        timer = Timer()
+        readers = self.open_readers(planner.sources())
+        planner.run(readers, resume)
+        for reader in readers.itervalues():
             reader.close()
-            print
-
+        for source, filename in links:
+            if os.path.lexists(filename):
+                os.remove(filename)
+            os.link(source, filename)
+        delta = timer.elapsed()
+        print
+        print 'Finished.'
+        print 'Wrote %i files in %i extents (%i seeks saved).' % \
+              (len(planner.files) - planner.skipped,
+               planner.planned_seeks,
+               planner.naive_seeks - planner.planned_seeks)
+        if planner.skipped > 0:
+            print 'Skipped %i complete files.' % planner.skipped
+        if len(links) > 0:
+            print 'Linked %i duplicates.' % len(links)
+        print 'Took %.2f seconds (%.1f MiB/s).' % \
+              (delta, float(planner.bytes_written) / float(1024**2) /
+               max(delta, 0.001))
+
+
+    def export_selection(self):
+        '''Return set of the first chunks of the recordings selected by the
+        arguments of parameter export (None if all recordings are
+        selected)'''
         if len(sys.argv) < 3:
-            # no special chunk specified -> export all
-            index = 1
-            for chunk in self.db_manager.chunk_query():
-                if chunk.concat is None:
-                    export_file(chunk, index)
-                    index += 1
-        else:
-            # only export specified chunk
-            index = 1
-            found = False
-            for chunk in self.db_manager.chunk_query():
-                if index == int(sys.argv[2]):
-                    found = True
-                    export_file(chunk, index)
+            return None
+        chunk_ids = set()
+        selected = set()
+        for arg in sys.argv[2:]:
+            for item in arg.split(','):
+                if item == '':
+                    continue
+                try:
+                    if '-' in item:
+                        start, end = [int(x) for x in item.split('-', 1)]
+                        if start > end:
+                            raise ValueError
+                    else:
+                        chunk_ids.add(int(item))
+                        continue
+                except ValueError:
+                    raise ExportError('Invalid chunk id or range: %s' % item)
+                # ids of deleted or dropped chunks leave gaps in ranges
+                chains = self.db_manager.chunk_query_chain_range(start, end)
+                if len(chains) == 0:
+                    raise ExportError('No chunks in range: %s' % item)
+                selected.update(chains)
+        chains = self.db_manager.chunk_query_chain_ids(chunk_ids)
+        missing = sorted(chunk_ids - set(chains))
+        if len(missing) > 0:
+            raise ExportError('Incorrect chunk specified: %s' %
+                              ', '.join(str(x) for x in missing[:10]))
+        selected.update(chains.itervalues())
+        return selected
+
+
+    def serve(self):
+        '''Serve recordings via HTTP'''
+        port = SERVE_PORT
+        if len(sys.argv) > 2:
+            port = int(sys.argv[2])
+        readers = self.open_readers(self.db_manager.chunk_query_sources())
+        lock = threading.Lock()
+        recordings = []
+        index = 1
+        for chunk in self.db_manager.chunk_query():
+            if chunk.concat is None:
+                recordings.append(RecordingStream(
+                    self.db_manager, chunk, readers[chunk.source],
+                    self.blocksize, self.recording_filename(chunk, index),
+                    lock))
                 index += 1
-            if not found:
-                raise ExportError('Incorrect chunk specified!')
+        server = RecordingServer(('127.0.0.1', port), recordings)
+        print 'Serving %i recordings on http://127.0.0.1:%i/' % \
+              (len(recordings), port)
+        print 'Press [CTRL] + [C] to stop the server.'
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            for reader in readers.itervalues():
+                reader.close()
 
 
     def run(self):
@@ -1144,8 +5192,9 @@ class Main(object):
         if len(sys.argv) < 2:
             self.usage()
             return
-        if sys.argv[1] in ('create', 'sort', 'reset', 'clear', 'show',
-                           'export', 'setup'):
+        if sys.argv[1] in ('create', 'survey', 'rechunk', 'sort', 'reset',
+                           'dedup', 'clear', 'show', 'export', 'serve',
+                           'setup'):
             self.db_manager.open(self.db_filename)
             self.load_settings()
             func = getattr(self, sys.argv[1])
@@ -1156,6 +5205,25 @@ class Main(object):
 
 
 
+def scan_source(db_filename, source, follow, bucket, started):
+    '''Scan source in a process of its own (see Main.create), the reads of
+    all processes are limited by the shared bucket of the RateLimiter'''
+    main = Main()
+    main.db_filename = db_filename
+    sys.stdout = PrefixWriter(sys.stdout, '[%s] ' % main.source_label(source))
+    main.db_manager.open(db_filename)
+    main.db_manager.share(source)
+    main.load_settings()
+    main.rate_limiter = RateLimiter(main.io_rate, main.io_priority,
+                                    bucket=bucket, started=started)
+    try:
+        main.scan(source, follow)
+    except KeyboardInterrupt:
+        sys.exit(1)
+    main.db_manager.close()
+
+
+
 if __name__ == '__main__':
     try:
         Main().run()
@@ -0,0 +1,74 @@
+'''Recordings stored more than once
+
+The image generated in a temporary directory contains a recording, an exact
+copy, a trimmed copy, an edited copy (a part cut out) and an unrelated
+recording whose clock range lies within the one of the first recording.'''
+
+import os.path
+import random
+import unittest
+
+from test_wraparound import BLOCKSIZE, ScriptTestCase, junk, \
+    ps_recording, ts_recording
+
+
+def write_image(filename, recording):
+    '''Write test image using function recording'''
+    rnd = random.Random(38)
+    original = recording(1000000, 400, rnd)
+    separator = junk(3, rnd)
+    data = [b'\x00' * BLOCKSIZE * 2,
+            original, separator,
+            original[BLOCKSIZE * 100:BLOCKSIZE * 300], separator,
+            original[:BLOCKSIZE * 150] + original[BLOCKSIZE * 170:],
+            separator,
+            original, separator,
+            recording(1010000, 100, rnd),
+            b'\x00' * BLOCKSIZE * 2]
+    f = open(filename, 'wb')
+    try:
+        f.write(b''.join(data))
+    finally:
+        f.close()
+
+
+class DedupTest(ScriptTestCase):
+    '''Find exact, trimmed and edited copies'''
+
+    def check(self, recording):
+        image = os.path.join(self.directory, 'image.bin')
+        write_image(image, recording)
+        self.run_script('setup', 'input', 'add', image)
+        self.run_script('setup', 'min_chunk_size', '10')
+        self.run_script('setup', 'cache_file', 'none')
+        self.run_script('create')
+        self.run_script('sort')
+        output = self.run_script('dedup')
+        self.assertTrue('Found 3 duplicates.' in output, output)
+
+        recordings = self.recordings()
+        self.assertEqual(len(recordings), 5)
+        duplicates = [item for item in recordings
+                      if item['duplicate_of'] is not None]
+        self.assertEqual(len(duplicates), 3)
+        originals = [item for item in recordings
+                     if item['duplicate_of'] is None]
+        self.assertEqual(sorted([item['clock_start'] for item in originals]),
+                         [1000000, 1010000])
+        # all copies refer to the complete recording
+        complete = max(originals, key=lambda x: x['size'])
+        self.assertEqual(set([item['duplicate_of'] for item in duplicates]),
+                         set([complete['number']]))
+
+
+    def test_program_stream(self):
+        self.check(ps_recording)
+
+
+    def test_transport_stream(self):
+        self.check(ts_recording)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
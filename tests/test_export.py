@@ -0,0 +1,109 @@
+'''Resuming exports
+
+The image generated in a temporary directory contains three recordings
+separated by junk. An export fails while reading the last one (the image is
+truncated after the scan), "export --resume" completes it.'''
+
+import os
+import os.path
+import random
+import unittest
+
+from test_wraparound import BLOCKSIZE, ScriptTestCase, junk, ps_recording
+
+
+def write_image(filename):
+    '''Write test image, return its contents'''
+    rnd = random.Random(43)
+    data = b''.join([b'\x00' * BLOCKSIZE * 2,
+                     ps_recording(1000000, 40, rnd), junk(3, rnd),
+                     ps_recording(5000000, 40, rnd), junk(3, rnd),
+                     ps_recording(9000000, 120, rnd),
+                     b'\x00' * BLOCKSIZE * 2])
+    f = open(filename, 'wb')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    return data
+
+
+class ExportResumeTest(ScriptTestCase):
+    '''Continue failed and finished exports'''
+
+    def setUp(self):
+        ScriptTestCase.setUp(self)
+        self.image = os.path.join(self.directory, 'image.bin')
+        self.data = write_image(self.image)
+        self.run_script('setup', 'input', 'add', self.image)
+        self.run_script('setup', 'min_chunk_size', '10')
+        self.run_script('setup', 'cache_file', 'none')
+        self.run_script('create')
+        self.run_script('sort')
+
+        # files of an export without failures
+        self.expected = self.export('expected')
+
+
+    def export(self, name, *args, **options):
+        '''Export into directory name, return dict of the files'''
+        export_dir = os.path.join(self.directory, name)
+        if not os.path.isdir(export_dir):
+            os.mkdir(export_dir)
+        self.run_script('setup', 'export_dir', export_dir)
+        self.output = self.run_script('export', *args, **options)
+        files = {}
+        for filename in os.listdir(export_dir):
+            f = open(os.path.join(export_dir, filename), 'rb')
+            try:
+                files[filename] = f.read()
+            finally:
+                f.close()
+        return files
+
+
+    def test_failed_export(self):
+        # the last recording can't be read completely
+        f = open(self.image, 'r+b')
+        try:
+            f.truncate(len(self.data) - BLOCKSIZE * 60)
+        finally:
+            f.close()
+        self.export('output', returncode=1)
+
+        f = open(self.image, 'wb')
+        try:
+            f.write(self.data)
+        finally:
+            f.close()
+        files = self.export('output', '--resume')
+        self.assertEqual(self.output.count('(complete)'), 2, self.output)
+        self.assertTrue('Skipped 2 complete files.' in self.output,
+                        self.output)
+        self.assertEqual(files, self.expected)
+
+
+    def test_finished_export(self):
+        files = self.export('expected', '--resume')
+        self.assertTrue('Skipped 3 complete files.' in self.output,
+                        self.output)
+        self.assertEqual(files, self.expected)
+
+
+    def test_changed_file(self):
+        filename = os.path.join(self.directory, 'expected',
+                                sorted(self.expected)[0])
+        f = open(filename, 'r+b')
+        try:
+            f.write(b'\x00' * BLOCKSIZE)
+        finally:
+            f.close()
+        files = self.export('expected', '--resume')
+        self.assertTrue('Skipped 2 complete files.' in self.output,
+                        self.output)
+        self.assertEqual(files, self.expected)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
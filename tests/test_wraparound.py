@@ -0,0 +1,210 @@
+'''Recordings crossing the wraparound of the 33 bit clock (SCR/PCR)
+
+The images are generated in a temporary directory. Every image contains
+
+ * a recording crossing the wraparound (create keeps it in one chunk),
+ * a recording ending in front of the wraparound, separated by junk from
+   its second part starting behind it (sort concatenates both parts) and
+ * an unrelated recording.
+
+dvr-recover.py requires Python 2: run the tests with it or set
+DVR_RECOVER_PYTHON to a Python 2 interpreter.'''
+
+import json
+import os
+import os.path
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import unittest
+
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'dvr-recover.py')
+PYTHON = os.environ.get('DVR_RECOVER_PYTHON', sys.executable)
+BLOCKSIZE = 2048
+CLOCK_MODULUS = 2**33
+# clock ticks per block of the generated recordings
+STEP = 300
+
+
+def ps_block(scr, rnd):
+    '''Return block with pack header (SCR) and video PES packet'''
+    block = bytearray(BLOCKSIZE)
+    block[0:4] = b'\x00\x00\x01\xba'
+    block[4] = 0x44 | (((scr >> 30) & 0x07) << 3) | ((scr >> 28) & 0x03)
+    block[5] = (scr >> 20) & 0xff
+    block[6] = 0x04 | (((scr >> 15) & 0x1f) << 3) | ((scr >> 13) & 0x03)
+    block[7] = (scr >> 5) & 0xff
+    block[8] = 0x04 | ((scr & 0x1f) << 3)
+    block[9] = 0x01
+    block[10:13] = b'\x01\x89\xc3'
+    block[13] = 0xf8
+    block[14:18] = b'\x00\x00\x01\xe0'
+    block[18:20] = struct.pack('>H', BLOCKSIZE - 20)
+    for i in range(20, BLOCKSIZE):
+        block[i] = rnd.randint(0, 255)
+    return bytes(block)
+
+
+def ts_packet(pcr, rnd):
+    '''Return transport stream packet (PID 0x100), with PCR if pcr is not
+    None'''
+    packet = bytearray(188)
+    packet[0:3] = b'\x47\x01\x00'
+    if pcr is None:
+        packet[3] = 0x10
+        start = 4
+    else:
+        packet[3] = 0x30
+        packet[4] = 7
+        packet[5] = 0x10
+        packet[6:10] = struct.pack('>I', pcr >> 1)
+        packet[10] = ((pcr & 1) << 7) | 0x7e
+        packet[11] = 0
+        start = 12
+    for i in range(start, 188):
+        packet[i] = rnd.randint(0, 255)
+    return bytes(packet)
+
+
+def ps_recording(clock, blocks, rnd):
+    '''Return program stream recording of blocks starting at clock'''
+    return b''.join([ps_block((clock + i * STEP) % CLOCK_MODULUS, rnd)
+                     for i in range(blocks)])
+
+
+def ts_recording(clock, blocks, rnd):
+    '''Return transport stream recording of blocks starting at clock, every
+    block contains a PCR'''
+    packets = []
+    size = 0
+    while size < blocks * BLOCKSIZE:
+        if len(packets) % 8 == 0:
+            pcr = (clock + len(packets) // 8 * STEP * 8 * 188 //
+                   BLOCKSIZE) % CLOCK_MODULUS
+        else:
+            pcr = None
+        packets.append(ts_packet(pcr, rnd))
+        size += 188
+    return b''.join(packets)[:blocks * BLOCKSIZE]
+
+
+def junk(blocks, rnd):
+    '''Return blocks of random data'''
+    return bytes(bytearray([rnd.randint(0, 255)
+                            for i in range(blocks * BLOCKSIZE)]))
+
+
+def write_image(filename, recording):
+    '''Write test image using function recording'''
+    rnd = random.Random(33)
+    data = [b'\x00' * BLOCKSIZE * 2,
+            # crossing the wraparound
+            recording(CLOCK_MODULUS - STEP * 20, 50, rnd),
+            junk(3, rnd),
+            # first part ends in front of the wraparound ...
+            recording(CLOCK_MODULUS - STEP * 30, 30, rnd),
+            junk(3, rnd),
+            # ... the second part starts behind it
+            recording(0, 30, rnd),
+            junk(3, rnd),
+            recording(5000000, 30, rnd),
+            b'\x00' * BLOCKSIZE * 2]
+    f = open(filename, 'wb')
+    try:
+        f.write(b''.join(data))
+    finally:
+        f.close()
+
+
+class ScriptTestCase(unittest.TestCase):
+    '''Run dvr-recover.py in a temporary directory'''
+
+    def setUp(self):
+        if (sys.version_info[0] != 2) and \
+           ('DVR_RECOVER_PYTHON' not in os.environ):
+            self.skipTest('dvr-recover.py requires Python 2 (set '
+                          'DVR_RECOVER_PYTHON)')
+        self.directory = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def run_script(self, *args, **options):
+        '''Run dvr-recover.py in the temporary directory, return output;
+        pass returncode if the script is expected to fail'''
+        process = subprocess.Popen([PYTHON, SCRIPT] + list(args),
+                                   cwd=self.directory,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        output = process.communicate()[0].decode('latin-1')
+        self.assertEqual(process.returncode, options.get('returncode', 0),
+                         output)
+        return output
+
+
+    def recordings(self, *args):
+        '''Return list of recordings printed by show --json'''
+        output = self.run_script('show', '--json', *args)
+        return [json.loads(line) for line in output.splitlines()
+                if line.startswith('{')]
+
+
+class WraparoundTest(ScriptTestCase):
+    '''Scan and sort images with recordings crossing the wraparound'''
+
+    def scan(self, recording):
+        '''Generate image, create and sort, return outputs'''
+        image = os.path.join(self.directory, 'image.bin')
+        write_image(image, recording)
+        self.run_script('setup', 'input', 'add', image)
+        self.run_script('setup', 'min_chunk_size', '10')
+        self.run_script('setup', 'cache_file', 'none')
+        return self.run_script('create'), self.run_script('sort')
+
+
+    def check(self, recording, chunk_format):
+        create, sort = self.scan(recording)
+        self.assertTrue('Found 4 chunks.' in create, create)
+        self.assertTrue('1 chunks continue across the wraparound of the '
+                        'clock (not split).' in create, create)
+        self.assertTrue('Concatenated 1 chunks across the wraparound of the '
+                        'clock.' in sort, sort)
+
+        recordings = self.recordings()
+        # numbered by the clock of their start
+        self.assertEqual([item['parts'] for item in recordings], [1, 2, 1])
+        self.assertEqual(set([item['format'] for item in recordings]),
+                         set([chunk_format]))
+        unrelated, joined, crossing = recordings
+        self.assertEqual(unrelated['clock_start'], 5000000)
+        self.assertEqual(crossing['clock_start'], CLOCK_MODULUS - STEP * 20)
+        self.assertTrue(crossing['clock_end'] < 50 * STEP)
+        self.assertEqual(joined['clock_start'], CLOCK_MODULUS - STEP * 30)
+        self.assertEqual(joined['chunks'][1]['clock_start'], 0)
+
+        # both recordings continuing behind the wraparound cover clock 100
+        self.assertEqual(len(self.recordings('--clock', '100:200')), 2)
+        self.assertEqual(len(self.recordings('--clock', ':100')), 2)
+        self.assertEqual(len(self.recordings('--clock', '20000:30000')), 0)
+        self.assertEqual(len(self.recordings('--clock', '%i:' %
+                                             (CLOCK_MODULUS - 100))), 2)
+
+
+    def test_program_stream(self):
+        self.check(ps_recording, 'ps')
+
+
+    def test_transport_stream(self):
+        self.check(ts_recording, 'ts')
+
+
+
+if __name__ == '__main__':
+    unittest.main()